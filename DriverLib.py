@@ -1,22 +1,153 @@
+import atexit
+import importlib
+import importlib.util
+import json
+import multiprocessing
 import os
+import queue
 import re
+import sqlite3
+import threading
 import time
+import uuid
+import weakref
+import zlib
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+from difflib import SequenceMatcher
+from functools import lru_cache, partial
+from urllib.parse import quote, urlparse
+
+
+class LazyImport(object):
+
+    # Module, or attribute of a module, imported on first use. The heavy
+    # dependencies are only loaded by the code paths using them, importing
+    # the library or running the CLI --help stays fast.
+    def __init__(self, module, attr=None):
+        self._module = module
+        self._attr = attr
+        self._target = None
+        pass
+
+    def _load(self):
+        if self._target is None:
+            target = importlib.import_module(self._module)
+            if self._attr is not None:
+                target = getattr(target, self._attr)
+            self._target = target
+        return self._target
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
 
-import numpy as np
-import pandas as pd
-import unidecode
-from babel import numbers
-from bs4 import BeautifulSoup
-from fuzzywuzzy import fuzz
-from selenium import webdriver
-from selenium.webdriver.common.by import By
-from selenium.webdriver.common.keys import Keys
-from selenium.webdriver.firefox.options import Options
-from selenium.webdriver.support import expected_conditions as ec
-from selenium.webdriver.support.ui import WebDriverWait
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        name = self._module if self._attr is None else self._module + "." + self._attr
+        return "LazyImport({})".format(name)
+
+    pass
 
 
-def get_browser(headless=True):
+np = LazyImport("numpy")
+pd = LazyImport("pandas")
+requests = LazyImport("requests")
+unidecode = LazyImport("unidecode")
+numbers = LazyImport("babel.numbers")
+BeautifulSoup = LazyImport("bs4", "BeautifulSoup")
+fuzz = LazyImport("fuzzywuzzy.fuzz")
+webdriver = LazyImport("selenium.webdriver")
+# except clauses need the class itself, use exceptions.TimeoutException
+exceptions = LazyImport("selenium.common.exceptions")
+Keys = LazyImport("selenium.webdriver.common.keys", "Keys")
+Options = LazyImport("selenium.webdriver.firefox.options", "Options")
+ec = LazyImport("selenium.webdriver.support.expected_conditions")
+WebDriverWait = LazyImport("selenium.webdriver.support.ui", "WebDriverWait")
+
+RAPIDFUZZ = importlib.util.find_spec("rapidfuzz") is not None
+rf_fuzz = LazyImport("rapidfuzz.fuzz")
+rf_process = LazyImport("rapidfuzz.process")
+
+
+class By(object):
+
+    # Locator strategies of the WebDriver protocol, the values of selenium
+    # By, so the drivers locators do not import selenium
+    ID = "id"
+    XPATH = "xpath"
+    LINK_TEXT = "link text"
+    PARTIAL_LINK_TEXT = "partial link text"
+    NAME = "name"
+    TAG_NAME = "tag name"
+    CLASS_NAME = "class name"
+    CSS_SELECTOR = "css selector"
+
+    pass
+
+
+# Third-party hosts blocked by the lean profile, ads and analytics only
+LEAN_BLOCKED_HOSTS = [
+    "google-analytics.com",
+    "googletagmanager.com",
+    "googletagservices.com",
+    "googlesyndication.com",
+    "googleadservices.com",
+    "doubleclick.net",
+    "facebook.net",
+    "connect.facebook.net",
+    "hotjar.com",
+    "criteo.com",
+    "criteo.net",
+    "scorecardresearch.com",
+    "newrelic.com",
+    "nr-data.net",
+    "taboola.com",
+    "outbrain.com",
+    "analytics.tiktok.com",
+    "bat.bing.com",
+    "clarity.ms",
+    "rtbhouse.com",
+]
+
+# Requests to blocked hosts go to a closed local port
+LEAN_PAC = """function FindProxyForURL(url, host) {
+    var blocked = %s;
+    for (var i = 0; i < blocked.length; i++) {
+        if (host == blocked[i] || dnsDomainIs(host, "." + blocked[i])) {
+            return "PROXY 127.0.0.1:9";
+        }
+    }
+    return "DIRECT";
+}"""
+
+
+def lean_preferences(allow=()):
+    # Firefox preferences of the lean scraping profile. allow whitelists
+    # "images", "fonts", "media" or blocked hosts for shops needing them.
+    prefs = {}
+    if "images" not in allow:
+        prefs["permissions.default.image"] = 2
+    if "fonts" not in allow:
+        prefs["gfx.downloadable_fonts.enabled"] = False
+        prefs["browser.display.use_document_fonts"] = 0
+    if "media" not in allow:
+        prefs["media.autoplay.default"] = 5
+        prefs["media.mediasource.enabled"] = False
+
+    blocked = [h for h in LEAN_BLOCKED_HOSTS if h not in allow]
+    if len(blocked) > 0:
+        pac = LEAN_PAC % json.dumps(blocked)
+        prefs["network.proxy.type"] = 2
+        prefs["network.proxy.autoconfig_url"] = "data:text/plain," + quote(pac)
+    prefs["privacy.trackingprotection.enabled"] = True
+    return prefs
+
+
+def get_browser(headless=True, lean=False, allow=()):
 
     # Download options
     profile = webdriver.FirefoxProfile()
@@ -27,6 +158,12 @@ def get_browser(headless=True):
     # Options
     options = Options()
     options.headless = headless
+    # Lean scraping, skip the resources not needed to read titles and prices
+    if lean:
+        for k, v in lean_preferences(allow).items():
+            profile.set_preference(k, v)
+        # Return from get() on DOMContentLoaded
+        options.set_capability("pageLoadStrategy", "eager")
     # Start broswer
     browser = webdriver.Firefox(profile, options=options)
     browser.delete_all_cookies()
@@ -34,90 +171,1316 @@ def get_browser(headless=True):
     return browser
 
 
+def count_commands(browser):
+    # Counts the WebDriver commands sent by the browser and its elements,
+    # the counter is kept on the browser
+    counts = getattr(browser, "command_counts", None)
+    if counts is None:
+        counts = Counter()
+        execute = browser.execute
+
+        def counted(command, params=None):
+            counts[command] += 1
+            return execute(command, params)
+
+        browser.execute = counted
+        browser.command_counts = counts
+    return counts
+
+
+# Pools still open when the process exits are closed, no geckodriver or
+# Firefox process is left behind
+_pools = weakref.WeakSet()
+
+
+@atexit.register
+def close_pools():
+    for pool in list(_pools):
+        pool.close()
+    pass
+
+
+# WebDriver errors leaving the browser unusable, any other exception
+# raised by a command means the connection to the driver was lost
+FATAL_ERRORS = (
+    "WebDriverException",
+    "InvalidSessionIdException",
+    "NoSuchWindowException",
+    "SessionNotCreatedException",
+)
+
+PSUTIL = importlib.util.find_spec("psutil") is not None
+
+
+def browser_rss(browser):
+    # Resident memory in MB of the driver and Firefox processes, None
+    # without psutil
+    if not PSUTIL:
+        return None
+    psutil = importlib.import_module("psutil")
+    try:
+        root = psutil.Process(browser.service.process.pid)
+        processes = [root] + root.children(recursive=True)
+    except Exception:
+        return None
+    rss = 0
+    for p in processes:
+        try:
+            rss += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss / 2**20
+
+
+class RecyclePolicy(object):
+
+    # When a browser is restarted: after max_navigations page loads, above
+    # max_rss MB (measured every check_every navigations, needs psutil) or
+    # after a failed WebDriver call
+    def __init__(self, max_navigations=500, max_rss=None, check_every=20):
+        self.max_navigations = max_navigations
+        self.max_rss = max_rss
+        self.check_every = check_every
+        pass
+
+    def reason(self, browser):
+        if browser.failed:
+            return "failure"
+        if (
+            self.max_navigations is not None
+            and browser.navigations >= self.max_navigations
+        ):
+            return "navigations"
+        if self.max_rss is not None and browser.navigations >= browser.checked:
+            browser.checked = browser.navigations + self.check_every
+            browser.rss = browser_rss(browser.driver)
+            if browser.rss is not None and browser.rss > self.max_rss:
+                return "rss"
+        return None
+
+    pass
+
+
+class RecyclingBrowser(object):
+
+    # Browser restarted by a RecyclePolicy, the attributes of the current
+    # WebDriver are forwarded so it is used as one. The restart only happens
+    # on recycle, called by ShopDriver before each search and by the pool on
+    # checkout, never in the middle of a search.
+    def __init__(self, factory, policy=None):
+        own = {
+            "factory": factory,
+            "policy": RecyclePolicy() if policy is None else policy,
+            "driver": None,
+            "navigations": 0,
+            "checked": 0,
+            "failed": False,
+            "rss": None,
+            "restarts": Counter(),
+        }
+        self.__dict__.update(own)
+        self.launch()
+        pass
+
+    def launch(self):
+        driver = self.factory()
+        execute = driver.execute
+
+        def watched(command, params=None):
+            try:
+                return execute(command, params)
+            except Exception as e:
+                fatal = type(e).__name__ in FATAL_ERRORS or not hasattr(e, "msg")
+                if fatal and self.driver is driver:
+                    self.__dict__["failed"] = True
+                raise
+
+        driver.execute = watched
+        self.__dict__.update(driver=driver, navigations=0, checked=0, failed=False)
+        pass
+
+    def __getattr__(self, name):
+        return getattr(self.driver, name)
+
+    def __setattr__(self, name, value):
+        if name in self.__dict__:
+            self.__dict__[name] = value
+        else:
+            setattr(self.driver, name, value)
+        pass
+
+    def get(self, url):
+        self.navigations += 1
+        return self.driver.get(url)
+
+    def recycle(self):
+        # Closes the stray tabs and windows and restarts the browser when
+        # the policy asks for it, returns the reason of the restart
+        reason = self.policy.reason(self)
+        if reason is None:
+            try:
+                handles = self.driver.window_handles
+                current = self.driver.current_window_handle
+                for handle in handles:
+                    if handle != current:
+                        self.driver.switch_to.window(handle)
+                        self.driver.close()
+                if len(handles) > 1:
+                    self.driver.switch_to.window(current)
+                return None
+            except Exception:
+                reason = "failure"
+
+        self.restart(reason)
+        return reason
+
+    def restart(self, reason="manual"):
+        try:
+            self.driver.quit()
+        except Exception:
+            pass
+        self.restarts[reason] += 1
+        self.rss = None
+        self.launch()
+        pass
+
+    def stats(self):
+        return {
+            "navigations": self.navigations,
+            "restarts": sum(self.restarts.values()),
+            "restart_reasons": dict(self.restarts),
+            "rss_mb": self.rss,
+        }
+
+    def quit(self):
+        self.driver.quit()
+        pass
+
+    pass
+
+
+class BrowserPool(object):
+
+    # Bounded pool of reusable browsers. size counts the idle, launching and
+    # checked out browsers. warm browsers are launched in background so the
+    # start up is off the request path. With a RecyclePolicy the browsers
+    # are restarted by it instead of growing for the pool lifetime.
+    def __init__(
+        self, size=2, headless=True, warm=0, lean=False, allow=(), recycle=None
+    ):
+        self.size = size
+        self.headless = headless
+        self.lean = lean
+        self.allow = allow
+        self.recycle = recycle
+        self.browsers = []
+        self.launched = 0
+        self.discarded = 0
+        self._idle = []
+        self._count = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._warmers = []
+        _pools.add(self)
+        if warm > 0:
+            self.prewarm(warm)
+        pass
+
+    def launch(self):
+        factory = partial(
+            get_browser, headless=self.headless, lean=self.lean, allow=self.allow
+        )
+        if self.recycle is None:
+            browser = factory()
+        else:
+            browser = RecyclingBrowser(factory, self.recycle)
+        with self._cond:
+            closed = self._closed
+            if not closed:
+                self.browsers += [browser]
+                self.launched += 1
+        if closed:
+            # The pool was closed while the browser was starting
+            try:
+                browser.quit()
+            except Exception:
+                pass
+            raise RuntimeError("Browser pool is closed")
+        return browser
+
+    def prewarm(self, n=None):
+        n = self.size if n is None else min(n, self.size)
+
+        def run():
+            for _ in range(n):
+                with self._cond:
+                    if self._closed or self._count >= self.size:
+                        return
+                    self._count += 1
+                try:
+                    browser = self.launch()
+                except Exception as e:
+                    if not self._closed:
+                        print("Fail to launch a browser!")
+                        print(e)
+                    with self._cond:
+                        self._count -= 1
+                        self._cond.notify()
+                    return
+                with self._cond:
+                    self._idle += [browser]
+                    self._cond.notify()
+
+        thread = threading.Thread(target=run, daemon=True)
+        with self._cond:
+            self._warmers = [t for t in self._warmers if t.is_alive()] + [thread]
+        thread.start()
+        return thread
+
+    def checkout(self):
+        while True:
+            with self._cond:
+                while True:
+                    if self._closed:
+                        raise RuntimeError("Browser pool is closed")
+                    if len(self._idle) > 0:
+                        browser = self._idle.pop()
+                        break
+                    if self._count < self.size:
+                        self._count += 1
+                        browser = None
+                        break
+                    self._cond.wait()
+
+            # No idle browser, launch a new one
+            if browser is None:
+                try:
+                    return self.launch()
+                except Exception:
+                    with self._cond:
+                        self._count -= 1
+                        self._cond.notify()
+                    raise
+
+            if self.recycle is not None:
+                try:
+                    browser.recycle()
+                except Exception:
+                    self.discard(browser)
+                    continue
+            if self.healthy(browser):
+                return browser
+            self.discard(browser)
+
+    def checkin(self, browser):
+        # The browser is reset instead of relaunched, broken ones are dropped
+        if self._closed or not self.reset(browser):
+            self.discard(browser)
+            return
+        with self._cond:
+            self._idle += [browser]
+            self._cond.notify()
+        pass
+
+    @contextmanager
+    def browser(self):
+        browser = self.checkout()
+        try:
+            yield browser
+        finally:
+            self.checkin(browser)
+
+    def healthy(self, browser):
+        try:
+            browser.current_url
+            return True
+        except Exception:
+            return False
+
+    def reset(self, browser):
+        try:
+            # Close the tabs and windows opened by the drivers
+            handles = browser.window_handles
+            for handle in handles[1:]:
+                browser.switch_to.window(handle)
+                browser.close()
+            browser.switch_to.window(handles[0])
+            # Clear the state of the last shop
+            browser.delete_all_cookies()
+            try:
+                browser.execute_script(
+                    "window.localStorage.clear(); window.sessionStorage.clear();"
+                )
+            except Exception:
+                pass
+            browser.get("about:blank")
+            return True
+        except Exception:
+            return False
+
+    def stats(self):
+        # Browsers launched and dropped by the pool, the restarts and the
+        # memory of the recycled browsers
+        with self._cond:
+            browsers = list(self.browsers)
+        out = {"launched": self.launched, "discarded": self.discarded}
+        recycled = [b.stats() for b in browsers if isinstance(b, RecyclingBrowser)]
+        if self.recycle is not None:
+            rss = [s["rss_mb"] for s in recycled if s["rss_mb"] is not None]
+            out["restarts"] = sum(s["restarts"] for s in recycled)
+            out["rss_mb"] = sum(rss) if len(rss) > 0 else None
+            out["browsers"] = recycled
+        return out
+
+    def discard(self, browser):
+        with self._cond:
+            if browser in self.browsers:
+                self.browsers.remove(browser)
+            self._count -= 1
+            self.discarded += 1
+            self._cond.notify()
+        try:
+            browser.quit()
+        except Exception:
+            pass
+        pass
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            browsers, self.browsers = self.browsers, []
+            warmers, self._warmers = self._warmers, []
+            self._idle = []
+            self._count = 0
+            self._cond.notify_all()
+        for b in browsers:
+            try:
+                b.quit()
+            except Exception:
+                pass
+        # A browser still starting is quit by launch once it is up
+        for thread in warmers:
+            if thread is not threading.current_thread():
+                thread.join()
+        _pools.discard(self)
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        pass
+
+    pass
+
+
+class HttpFetcher(object):
+
+    # Plain HTTP backend with a pooled session shared by the drivers
+    headers = {
+        "User-Agent": (
+            "Mozilla/5.0 (X11; Linux x86_64; rv:80.0) Gecko/20100101 Firefox/80.0"
+        ),
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "pt-BR,pt;q=0.8,en-US;q=0.5,en;q=0.3",
+    }
+
+    def __init__(self, pool_size=10, timeout=10, headers=None):
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(self.headers if headers is None else headers)
+        pass
+
+    def get(self, url):
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.text
+
+    def close(self):
+        self.session.close()
+        pass
+
+    pass
+
+
+CLEAN_PRICE = re.compile("[^-0-9.,]")
+
+
 def clean_price(price, replace=None):
     if replace is not None:
         price = price.replace(*replace)
-    return re.sub("[^-0-9.,]", "", price)
+    return CLEAN_PRICE.sub("", price)
 
 
-def create_prod_detail(price, info=None, shop=None, locale="pt_BR", **kwargs):
+class PriceParser(object):
 
-    prod_lst = []
+    # Number format of a locale resolved once, parses whole columns of raw
+    # prices with the same rules as babel.numbers.parse_decimal
+    def __init__(self, locale="pt_BR"):
+        self.locale = locale
+        self.decimal = numbers.get_decimal_symbol(locale)
+        self.group = numbers.get_group_symbol(locale)
+        pass
 
-    if type(price) is str:
-        price = clean_price(price, **kwargs)
+    def parse(self, prices, replace=None):
+        # Returns the float values and a mask of the prices not parsed
+        raw = pd.Series(list(prices), dtype=object)
+        if replace is not None:
+            raw = raw.str.replace(replace[0], replace[1], regex=False)
+        raw = raw.str.replace(CLEAN_PRICE, "", regex=True)
+        raw = raw.str.replace(self.group, "", regex=False)
+        raw = raw.str.replace(self.decimal, ".", regex=False)
 
-        prod_detail = {"info": info}
-        prod_detail["price"] = float(numbers.parse_decimal(price, locale=locale))
+        values = pd.to_numeric(raw, errors="coerce").to_numpy(dtype=np.float64)
+        errors = np.isnan(values)
+        return values, errors
 
-        if shop is not None:
-            prod_detail["shop"] = shop
+    pass
+
+
+@lru_cache(maxsize=None)
+def get_price_parser(locale="pt_BR"):
+    return PriceParser(locale)
 
-        prod_lst += [prod_detail]
-    else:
-        for p in price:
-            if "price" not in p.keys():
-                continue
-            p["price"] = clean_price(p["price"], **kwargs)
-            p["price"] = float(numbers.parse_decimal(p["price"], locale=locale))
-            if info is not None:
-                p["info"] = info
-            if shop is not None:
-                p["shop"] = shop
 
-            prod_lst += [p]
+def parse_prices(prices, locale="pt_BR", replace=None):
+    return get_price_parser(locale).parse(prices, replace=replace)
+
+
+class Offer(object):
+
+    # Offer record with a fixed schema. It behaves as the dicts used before,
+    # the keys are the fields that are set.
+    __slots__ = ("info", "price", "shop", "product", "currency", "timestamp")
+
+    def __init__(
+        self,
+        info=None,
+        price=None,
+        shop=None,
+        product=None,
+        currency=None,
+        timestamp=None,
+    ):
+        self.info = info
+        self.price = price
+        self.shop = shop
+        self.product = product
+        self.currency = currency
+        self.timestamp = timestamp
+        pass
+
+    @classmethod
+    def from_mapping(cls, offer):
+        return cls(*[offer.get(k) for k in cls.__slots__])
+
+    def __getitem__(self, key):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+        pass
+
+    def __contains__(self, key):
+        return key in self.__slots__ and getattr(self, key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if isinstance(other, (Offer, dict)):
+            return self.to_dict() == dict(other)
+        return NotImplemented
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None) if key in self.__slots__ else None
+        return default if value is None else value
+
+    def keys(self):
+        return [k for k in self.__slots__ if getattr(self, k) is not None]
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.keys()]
+
+    def copy(self):
+        return Offer(*[getattr(self, k) for k in self.__slots__])
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return "Offer({})".format(
+            ", ".join("{}={!r}".format(k, v) for k, v in self.items())
+        )
+
+    pass
+
+
+class OfferBatch(object):
+
+    # Columnar offers with the Offer schema, float64 arrays for price and
+    # timestamp (epoch seconds) and object arrays for the text columns. to_frame wraps the
+    # arrays without copying them.
+    schema = {
+        "info": object,
+        "price": "float64",
+        "shop": object,
+        "product": object,
+        "currency": object,
+        "timestamp": "float64",
+    }
+
+    def __init__(self, columns):
+        self.columns = columns
+        pass
+
+    @classmethod
+    def from_offers(cls, offers, **defaults):
+        # offers are Offer records or dicts, defaults fill the missing fields
+        n = len(offers)
+        columns = {}
+        for k, dtype in cls.schema.items():
+            default = defaults.get(k)
+            if dtype == object:
+                columns[k] = np.empty(n, dtype=object)
+                columns[k][:] = [o.get(k, default) for o in offers]
+            else:
+                default = np.nan if default is None else to_epoch(default)
+                values = (o.get(k) for o in offers)
+                values = (default if v is None else v for v in values)
+                columns[k] = np.fromiter(values, dtype=dtype, count=n)
+        return cls(columns)
+
+    @classmethod
+    def concat(cls, batches):
+        batches = list(batches)
+        if len(batches) == 0:
+            return cls.from_offers([])
+        columns = {}
+        for k in cls.schema:
+            columns[k] = np.concatenate([b.columns[k] for b in batches])
+        return cls(columns)
+
+    def __len__(self):
+        return len(self.columns["price"])
+
+    def __getitem__(self, i):
+        values = [self.columns[k][i] for k in self.schema]
+        values = [None if v is None or v != v else v for v in values]
+        return Offer(*values)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def to_frame(self):
+        # timestamp is kept in epoch seconds, a datetime column is a copy.
+        # The dtypes are explicit or pandas may convert the text columns.
+        columns = {}
+        for k, v in self.columns.items():
+            columns[k] = pd.Series(v, dtype=v.dtype, copy=False)
+        return pd.DataFrame(columns, copy=False)
+
+    def to_arrow(self):
+        pa = importlib.import_module("pyarrow")
+        return pa.table({k: v for k, v in self.columns.items()})
+
+    pass
+
+
+def offers_frame(offers, **defaults):
+    # DataFrame of a list of offers, an OfferBatch or a DataFrame
+    if isinstance(offers, pd.DataFrame):
+        return offers
+    if not isinstance(offers, OfferBatch):
+        offers = OfferBatch.from_offers(list(offers), **defaults)
+    return offers.to_frame()
+
+
+def create_prod_detail(
+    price, info=None, shop=None, locale="pt_BR", currency=None, **kwargs
+):
+
+    parser = get_price_parser(locale)
+    timestamp = time.time()
+
+    if type(price) is str:
+        values, errors = parser.parse([price], **kwargs)
+        if errors[0]:
+            return []
+
+        return [Offer(info, float(values[0]), shop, None, currency, timestamp)]
+
+    # Parse all the prices at once, unparsed prices are dropped
+    items = [p for p in price if "price" in p.keys()]
+    values, errors = parser.parse([p["price"] for p in items], **kwargs)
+
+    prod_lst = []
+    for p, value, error in zip(items, values.tolist(), errors):
+        if error:
+            continue
+        prod_lst.append(
+            Offer(
+                p.get("info") if info is None else info,
+                value,
+                p.get("shop") if shop is None else shop,
+                None,
+                currency,
+                timestamp,
+            )
+        )
 
     return prod_lst
 
 
-def filter_products(target, products, exclude=[], include=[], or_include=False):
-    fuzz_limit = 90
+FUZZ_LIMIT = 90
+
+# fuzzywuzzy full_process drops the latin-1 range and replaces the non
+# word characters by spaces before scoring
+_ASCII_ONLY = dict.fromkeys(range(128, 256))
+_NON_WORD = re.compile(r"(?ui)\W")
 
-    # Transform filters to lower case
+
+def full_process(title):
+    return _NON_WORD.sub(" ", title.translate(_ASCII_ONLY)).lower().strip()
+
+
+def _ratio(a, b):
+    if a == b:
+        return 100
+    if len(a) == 0 or len(b) == 0:
+        return 0
+    return int(round(100 * SequenceMatcher(None, a, b).ratio()))
+
+
+def fuzzywuzzy_score(p1, p2):
+    # fuzzywuzzy token_set_ratio of processed titles, with the difflib ratio
+    # of its pure Python install
+    if len(p1) == 0 or len(p2) == 0:
+        return 0
+    tokens1 = set(p1.split())
+    tokens2 = set(p2.split())
+    sect = " ".join(sorted(tokens1 & tokens2))
+    combined_1to2 = (sect + " " + " ".join(sorted(tokens1 - tokens2))).strip()
+    combined_2to1 = (sect + " " + " ".join(sorted(tokens2 - tokens1))).strip()
+    return max(
+        _ratio(sect, combined_1to2),
+        _ratio(sect, combined_2to1),
+        _ratio(combined_1to2, combined_2to1),
+    )
+
+
+def prepare_titles(titles):
+    # Normalise the titles once for the scorer and the include/exclude sets
+    tokens = [set(t.lower().split(" ")) for t in titles]
+    if not RAPIDFUZZ:
+        return list(titles), tokens
+    processed = [full_process(t) for t in titles]
+    return processed, tokens
+
+
+def filter_mask(tokens, exclude=[], include=[], or_include=False):
+    # Cheap set checks, done before any fuzzy scoring
     exclude_set = set([e.lower() for e in exclude])
     include_set = set([i.lower() for i in include])
+    add_factor = (len(include) - 1) * or_include
+
+    mask = np.ones(len(tokens), dtype=bool)
+    for i, info_set in enumerate(tokens):
+        if len(info_set & exclude_set) > 0:
+            mask[i] = False
+        elif len(include_set - info_set) > add_factor:
+            mask[i] = False
+    return mask
+
+
+def match_scores(
+    targets,
+    titles,
+    exclude=[],
+    include=[],
+    or_include=False,
+    workers=-1,
+    fuzz_limit=FUZZ_LIMIT,
+):
+    # Similarity matrix (targets x titles), filtered out titles score 0.
+    # The scores above fuzz_limit are the fuzzywuzzy ones, the others may be
+    # a bit higher.
+    processed, tokens = prepare_titles(titles)
+    mask = filter_mask(tokens, exclude, include, or_include)
+
+    scores = np.zeros((len(targets), len(titles)))
+    if not mask.any() or len(targets) == 0:
+        return scores
+
+    idx = np.flatnonzero(mask)
+    candidates = [processed[i] for i in idx]
+    if not RAPIDFUZZ:
+        for t, target in enumerate(targets):
+            for j, title in zip(idx, candidates):
+                scores[t, j] = fuzz.token_set_ratio(target, title)
+        return scores
+
+    queries = [full_process(t) for t in targets]
+    sim = rf_process.cdist(
+        queries,
+        candidates,
+        scorer=rf_fuzz.token_set_ratio,
+        dtype=np.float64,
+        workers=workers,
+    )
+    # fuzzywuzzy rounds the ratio to an integer
+    rounded = np.rint(np.round(sim, 6))
+    # The Indel ratio of rapidfuzz is never below the difflib one, only the
+    # accepted pairs that are not equal are scored again
+    for t, j in zip(*np.nonzero((rounded > fuzz_limit) & (sim < 100))):
+        rounded[t, j] = fuzzywuzzy_score(queries[t], candidates[j])
+    scores[:, idx] = rounded
+    return scores
+
+
+def match_products(
+    targets,
+    products,
+    exclude=[],
+    include=[],
+    or_include=False,
+    fuzz_limit=FUZZ_LIMIT,
+    limit=None,
+    workers=-1,
+):
+    # Returns a list of accepted products for each target, best first when
+    # limit is given
+    titles = [p["info"] for p in products]
+    scores = match_scores(
+        targets, titles, exclude, include, or_include, workers, fuzz_limit
+    )
 
     out = []
-    for i, p in enumerate(products):
-        # i = 0
-        # p = products[i]
-        # Check similarity
-        fuzz_val = fuzz.token_set_ratio(target, p["info"])
-        if fuzz_val > fuzz_limit:
-            # Lower case info
-            info_set = set(p["info"].lower().split(" "))
-            # Filter products
-            if len(info_set - exclude_set) != len(info_set):
-                continue
-            add_factor = (len(include) - 1) * or_include
-            if len(info_set | include_set) > (len(info_set) + add_factor):
-                continue
-            out += [p]
+    for row in scores:
+        idx = np.flatnonzero(row > fuzz_limit)
+        if limit is not None:
+            idx = idx[np.argsort(-row[idx], kind="stable")][:limit]
+        out += [[products[i] for i in idx]]
     return out
 
 
-def extract_products(grid, class_name=None, id_val=None):
-    n_trials = 10
+def filter_products(target, products, exclude=[], include=[], or_include=False):
+    out = match_products([target], products, exclude, include, or_include, workers=1)
+    return out[0]
+
+
+# Tokens with letters and digits, e.g. "50um751c0sb" or "my232bz"
+MODEL_CODE = re.compile(r"^(?=.*[0-9])(?=.*[a-z])[a-z0-9]{5,}$")
+# Measures that look like model codes, e.g. "1080p", "128gb" or "55pol"
+MEASURE = re.compile(
+    r"^[0-9]+(gb|tb|mb|hz|w|v|mah|pol|polegadas|p|k|mp|mm|cm|m|g|kg|ml|l|x)$"
+)
+NOT_ALNUM = re.compile(r"[^a-z0-9- ]+")
+
+
+def normalize_title(title):
+    title = unidecode.unidecode(title).lower()
+    return " ".join(NOT_ALNUM.sub(" ", title).split())
+
+
+def model_codes(title):
+    # Model number like tokens of a title, hyphens are dropped
+    codes = []
+    for token in normalize_title(title).split(" "):
+        token = token.replace("-", "")
+        if MODEL_CODE.match(token) and not MEASURE.match(token):
+            codes += [token]
+    return codes
+
+
+def fuzz_score(a, b):
+    if not RAPIDFUZZ:
+        return fuzz.token_set_ratio(a, b)
+    return rf_fuzz.token_set_ratio(a, b)
+
+
+def similar_pairs(titles, threshold=FUZZ_LIMIT):
+    # Index pairs of a block with a similarity above threshold
+    if len(titles) < 2:
+        return []
+    if not RAPIDFUZZ:
+        pairs = []
+        for i in range(len(titles)):
+            for j in range(i + 1, len(titles)):
+                if fuzz.token_set_ratio(titles[i], titles[j]) > threshold:
+                    pairs += [(i, j)]
+        return pairs
+    sim = rf_process.cdist(
+        titles, titles, scorer=rf_fuzz.token_set_ratio, score_cutoff=threshold + 1
+    )
+    i, j = np.nonzero(np.triu(sim, k=1))
+    return list(zip(i.tolist(), j.tolist()))
+
+
+# Leading words that do not tell the product type, e.g. "Smart TV"
+TYPE_QUALIFIERS = {"smart", "novo", "nova", "kit", "original", "oficial"}
+
+
+def product_type(title):
+    # First word of a normalized title that is not a qualifier, a number or
+    # a model code: "tv", "controle", "suporte"...
+    for token in title.split(" "):
+        code = token.replace("-", "")
+        if token in TYPE_QUALIFIERS or code.isdigit() or MODEL_CODE.match(code):
+            continue
+        return token
+    return ""
+
+
+def cluster_offers(df, column="info", threshold=FUZZ_LIMIT, max_block=200, window=20):
+    # Adds a "cluster" column grouping the offers of the same product.
+    # Offers are blocked by model code and product type, e.g. a TV and its
+    # remote control with the TV model in the title are apart, and the
+    # others by their two rarest tokens. Offers with a single model code
+    # sharing a block are the same product. Titles with several codes only
+    # join the most similar offer of their blocks, so they do not bridge two
+    # models. Inside the token blocks offers are compared with the fuzzy
+    # ratio. Blocks above max_block are sorted and only compared with the
+    # next window offers, keeping the cost close to linear.
+    titles = [normalize_title(t) for t in df[column].fillna("").astype(str)]
+    n = len(titles)
+    parent = list(range(n))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        i, j = find(i), find(j)
+        if i != j:
+            parent[max(i, j)] = min(i, j)
+
+    # Blocking keys
+    codes = [sorted(set(model_codes(t))) for t in titles]
+    types = [product_type(t) for t in titles]
+    tokens = [set(t.split(" ")) - {""} for t in titles]
+    freq = Counter()
+    for i in range(n):
+        if len(codes[i]) == 0:
+            freq.update(tokens[i])
+
+    code_blocks = {}
+    multi_code = []
+    token_blocks = {}
+    for i in range(n):
+        if len(codes[i]) == 1:
+            code_blocks.setdefault((codes[i][0], types[i]), []).append(i)
+        elif len(codes[i]) > 1:
+            multi_code += [i]
+        elif len(tokens[i]) > 0:
+            rare = sorted(tokens[i], key=lambda t: (freq[t], t))[:2]
+            token_blocks.setdefault(tuple(sorted(rare)), []).append(i)
+
+    # Codes shared by too many offers are not model numbers, their offers
+    # are compared like the token blocks
+    fuzzy_blocks = list(token_blocks.values())
+    for block in code_blocks.values():
+        if len(block) > max_block:
+            fuzzy_blocks += [block]
+            continue
+        for i in block[1:]:
+            union(block[0], i)
+
+    same_codes = {}
+    for i in multi_code:
+        candidates = []
+        for code in codes[i]:
+            candidates += code_blocks.get((code, types[i]), [])[:max_block]
+        if len(candidates) == 0:
+            # Only grouped with the titles of the same codes
+            key = (tuple(codes[i]), types[i])
+            union(same_codes.setdefault(key, i), i)
+            continue
+        scores = [fuzz_score(titles[i], titles[k]) for k in candidates]
+        union(candidates[int(np.argmax(scores))], i)
+
+    for block in fuzzy_blocks:
+        if len(block) <= max_block:
+            for i, j in similar_pairs([titles[k] for k in block], threshold):
+                union(block[i], block[j])
+            continue
+        block = sorted(block, key=lambda k: titles[k])
+        for start in range(0, len(block), window):
+            chunk = block[start : start + 2 * window]
+            for i, j in similar_pairs([titles[k] for k in chunk], threshold):
+                union(chunk[i], chunk[j])
+
+    # Cluster ids numbered in order of appearance
+    ids = {}
+    cluster = [ids.setdefault(find(i), len(ids)) for i in range(n)]
+    out = df.copy()
+    out["cluster"] = cluster
+    return out
+
+
+def best_prices(df, column="info"):
+    # Cheapest offer of each product found in the scan
+    if "cluster" not in df.columns:
+        df = cluster_offers(df, column)
+    df = df.dropna(subset=["price"])
+    best = df.loc[df.groupby("cluster")["price"].idxmin()]
+    return best.sort_values(by="price").reset_index(drop=True)
+
+
+class OfferIndex(object):
+
+    # Inverted index of offer titles to find the candidates of a target
+    # before the fuzzy ratio. Model codes and their n-grams are the keys of
+    # the targets with model numbers, the other targets use the title tokens.
+    # Offers are added incrementally as the scans arrive.
+    def __init__(self, ngram=3, min_overlap=0.6):
+        self.ngram = ngram
+        self.min_overlap = min_overlap
+        self.offers = {}
+        self.codes = {}
+        self.grams = {}
+        self.tokens = {}
+        self._keys = {}
+        self._next = 0
+        self._lock = threading.Lock()
+        pass
+
+    def __len__(self):
+        return len(self.offers)
+
+    def ngrams(self, code):
+        n = self.ngram
+        return set([code[i : i + n] for i in range(max(1, len(code) - n + 1))])
+
+    def add(self, offers):
+        # Returns the ids of the added offers
+        ids = []
+        with self._lock:
+            for offer in offers:
+                i = self._next
+                self._next += 1
+                title = normalize_title(offer["info"])
+                codes = set(model_codes(title))
+                grams = set()
+                for code in codes:
+                    grams |= self.ngrams(code)
+                tokens = set(title.split(" ")) - {""}
+
+                self.offers[i] = offer
+                self._keys[i] = (codes, grams, tokens)
+                for key, postings in [
+                    (codes, self.codes),
+                    (grams, self.grams),
+                    (tokens, self.tokens),
+                ]:
+                    for k in key:
+                        postings.setdefault(k, set()).add(i)
+                ids += [i]
+        return ids
+
+    def remove(self, ids):
+        with self._lock:
+            for i in ids:
+                if i not in self.offers:
+                    continue
+                del self.offers[i]
+                codes, grams, tokens = self._keys.pop(i)
+                for key, postings in [
+                    (codes, self.codes),
+                    (grams, self.grams),
+                    (tokens, self.tokens),
+                ]:
+                    for k in key:
+                        postings[k].discard(i)
+                        if len(postings[k]) == 0:
+                            del postings[k]
+        pass
+
+    def candidates(self, target):
+        # Ids of the offers worth scoring against target
+        title = normalize_title(target)
+        codes = model_codes(title)
+        with self._lock:
+            if len(codes) == 0:
+                out = set()
+                for token in set(title.split(" ")) - {""}:
+                    out |= self.tokens.get(token, set())
+                return out
+
+            out = set()
+            for code in codes:
+                out |= self.codes.get(code, set())
+                # Partial or misspelled codes share most of their n-grams
+                grams = self.ngrams(code)
+                shared = Counter()
+                for g in grams:
+                    shared.update(self.grams.get(g, ()))
+                need = self.min_overlap * len(grams)
+                out |= set([i for i, n in shared.items() if n >= need])
+            return out
+
+    def match(self, target, exclude=[], include=[], or_include=False):
+        ids = sorted(self.candidates(target))
+        with self._lock:
+            products = [self.offers[i] for i in ids if i in self.offers]
+        return filter_products(target, products, exclude, include, or_include)
+
+    def match_many(self, targets, exclude=[], include=[], or_include=False):
+        return [self.match(t, exclude, include, or_include) for t in targets]
+
+    pass
+
 
-    # Get grid products
-    for i in range(n_trials):
+def extract_products(grid, class_name=None, id_val=None, timeout=10):
+    def find(grid):
         if class_name is not None:
-            products = grid.find_elements_by_class_name(class_name)
+            return grid.find_elements_by_class_name(class_name)
         elif id_val is not None:
-            products = grid.find_elements_by_id(id_val)
-        else:
-            products = []
-        # Wait 1 second in case the grid was not loaded
-        if len(products) == 0:
-            time.sleep(1)
-        else:
-            break
+            return grid.find_elements_by_id(id_val)
+        return []
+
+    # Get grid products, returns as soon as the grid has products
+    try:
+        wait = WebDriverWait(grid, timeout, poll_frequency=0.2)
+        products = wait.until(find)
+    except exceptions.TimeoutException:
+        products = []
 
     return products
 
 
-def craw_products(items, class_name={}, id_val={}):
+class ReadyCondition(object):
+
+    # Base readiness condition. check is polled with a state dict that is
+    # private to each wait, so conditions can be shared by the drivers.
+    name = "ready"
+
+    def __init__(self, css):
+        self.css = css
+        pass
+
+    def check(self, browser, state):
+        raise NotImplementedError
+
+    pass
+
+
+class GridSettled(ReadyCondition):
+
+    # Grid item count is above zero and unchanged for settle seconds
+    name = "grid_settled"
+    script = "return document.querySelectorAll(arguments[0]).length;"
+
+    def __init__(self, css, settle=0.5):
+        self.css = css
+        self.settle = settle
+        pass
+
+    def check(self, browser, state):
+        count = browser.execute_script(self.script, self.css)
+        now = time.perf_counter()
+        if count == 0 or count != state.get("count"):
+            state["count"] = count
+            state["since"] = now
+            return False
+        return now - state["since"] >= self.settle
+
+    pass
+
+
+class PricesPopulated(ReadyCondition):
+
+    # Every price node found has some text
+    name = "prices_populated"
+    script = """
+    var nodes = document.querySelectorAll(arguments[0]);
+    if (nodes.length === 0) return false;
+    for (var i = 0; i < nodes.length; i++) {
+        if (!nodes[i].textContent.trim()) return false;
+    }
+    return true;
+    """
+
+    def check(self, browser, state):
+        return browser.execute_script(self.script, self.css)
+
+    pass
+
+
+class NetworkIdle(ReadyCondition):
+
+    # No new resource was requested by the page for idle seconds
+    name = "network_idle"
+    script = "return performance.getEntriesByType('resource').length;"
+
+    def __init__(self, idle=0.5):
+        self.css = None
+        self.idle = idle
+        pass
+
+    def check(self, browser, state):
+        count = browser.execute_script(self.script)
+        now = time.perf_counter()
+        if count != state.get("count"):
+            state["count"] = count
+            state["since"] = now
+            return False
+        return now - state["since"] >= self.idle
+
+    pass
+
+
+class NotFound(ReadyCondition):
+
+    # Shop "product not found" marker is present
+    name = "not_found"
+    script = "return document.querySelector(arguments[0]) !== null;"
+
+    def check(self, browser, state):
+        return browser.execute_script(self.script, self.css)
+
+    pass
+
+
+class ReadinessLog(object):
+
+    # Keeps the last wait timings to tune the shops timeouts
+    def __init__(self, maxlen=10000):
+        self.records = deque(maxlen=maxlen)
+        pass
+
+    def record(self, shop, condition, elapsed, satisfied):
+        self.records.append((shop, condition, elapsed, satisfied))
+        pass
+
+    def summary(self):
+        columns = ["shop", "condition", "elapsed", "satisfied"]
+        df = pd.DataFrame(list(self.records), columns=columns)
+        group = df.groupby(["shop", "condition"])["elapsed"]
+        return group.describe(percentiles=[0.5, 0.95, 0.99])
+
+    pass
+
+
+readiness_log = ReadinessLog()
+
+
+class ReadyWait(object):
+
+    poll = 0.1
+
+    def __init__(self, browser, shop, timeout, log=None):
+        self.browser = browser
+        self.shop = shop
+        self.log = readiness_log if log is None else log
+        # Single deadline shared by all the conditions of the wait
+        self.deadline = time.perf_counter() + timeout
+        pass
+
+    def until(self, condition, not_found=None):
+        # Returns True when condition is satisfied and False when the not
+        # found marker shows up first
+        browser = self.browser
+        state = {}
+        start = time.perf_counter()
+        while True:
+            if not_found is not None and not_found.check(browser, {}):
+                elapsed = time.perf_counter() - start
+                self.log.record(self.shop, not_found.name, elapsed, True)
+                return False
+            if condition.check(browser, state):
+                elapsed = time.perf_counter() - start
+                self.log.record(self.shop, condition.name, elapsed, True)
+                return True
+            if time.perf_counter() > self.deadline:
+                elapsed = time.perf_counter() - start
+                self.log.record(self.shop, condition.name, elapsed, False)
+                raise exceptions.TimeoutException("{} not ready".format(condition.name))
+            time.sleep(self.poll)
+
+    pass
+
+
+# Extract the fields of every item in a single WebDriver call. Text is
+# normalised close to the WebElement.text output, the text rendered but not
+# visible (transparent, clipped or off the page) is skipped like it does,
+# e.g. the screen reader copy of the Amazon prices. innerText already skips
+# the hidden visibility.
+CRAW_SCRIPT = """
+var items = arguments[0], classNames = arguments[1], ids = arguments[2];
+function hidden(el) {
+    var style = window.getComputedStyle(el), rect;
+    if (parseFloat(style.opacity) === 0) return true;
+    rect = el.getBoundingClientRect();
+    if (rect.right + window.scrollX <= 0 || rect.bottom + window.scrollY <= 0) {
+        return true;
+    }
+    if (style.position === "absolute" && style.clip === "rect(0px, 0px, 0px, 0px)") {
+        return true;
+    }
+    return (rect.width <= 1 || rect.height <= 1) && style.overflow === "hidden";
+}
+function text(el) {
+    var nodes = el.getElementsByTagName("*"), hide = [], out, i, s;
+    if (hidden(el)) return "";
+    for (i = 0; i < nodes.length; i++) {
+        if (hidden(nodes[i])) hide.push(nodes[i]);
+    }
+    // innerText skips the elements not displayed
+    hide = hide.map(function (node) {
+        s = node.style;
+        return [s, s.getPropertyValue("display"), s.getPropertyPriority("display")];
+    });
+    try {
+        hide.forEach(function (h) { h[0].setProperty("display", "none", "important"); });
+        out = el.innerText;
+    } finally {
+        hide.forEach(function (h) {
+            if (h[1]) h[0].setProperty("display", h[1], h[2]);
+            else h[0].removeProperty("display");
+        });
+    }
+    return out.replace(/[ \\t\\u00a0]+/g, " ").replace(/ *\\n */g, "\\n").trim();
+}
+return items.map(function (item) {
+    var out = {}, k, el;
+    for (k in classNames) {
+        el = item.getElementsByClassName(classNames[k])[0];
+        if (!el) return {};
+        out[k] = text(el);
+    }
+    for (k in ids) {
+        el = item.querySelector('[id="' + ids[k] + '"]');
+        if (!el) return {};
+        out[k] = text(el);
+    }
+    return out;
+});
+"""
+
+
+def craw_products(items, class_name={}, id_val={}, browser=None):
     # example class_name = {"info": "class_name1", "price": "class_name2"}
+    if browser is not None and len(items) > 0:
+        return browser.execute_script(CRAW_SCRIPT, items, class_name, id_val)
+
     out = []  # variable to return
     aux = {}  # temporary store the info from items
     for i in items:
@@ -142,28 +1505,627 @@ def craw_products(items, class_name={}, id_val={}):
     return out
 
 
+class ScanMetrics(object):
+
+    # Phase timings and offer counts per shop and query. Records are kept
+    # for the last scans only, the aggregates feed the metrics export.
+    def __init__(self, maxlen=100000):
+        self.records = deque(maxlen=maxlen)
+        self.counts = deque(maxlen=maxlen)
+        self.phases = {}
+        self.offers = {}
+        self._lock = threading.Lock()
+        pass
+
+    @contextmanager
+    def phase(self, shop, product, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(shop, product, name, time.perf_counter() - start)
+
+    def add(self, shop, product, name, seconds):
+        with self._lock:
+            self.records.append((time.time(), shop, product, name, seconds))
+            agg = self.phases.setdefault((shop, name), [0.0, 0])
+            agg[0] += seconds
+            agg[1] += 1
+        pass
+
+    def count(self, shop, product, found, kept, success):
+        with self._lock:
+            self.counts.append((time.time(), shop, product, found, kept, success))
+            agg = self.offers.setdefault(shop, [0, 0, 0, 0])
+            agg[0] += found
+            agg[1] += kept
+            agg[2 if success else 3] += 1
+        pass
+
+    def update(self, other):
+        # Adds the records and aggregates of other, e.g. a single scan
+        with other._lock:
+            records, counts = list(other.records), list(other.counts)
+            phases, offers = dict(other.phases), dict(other.offers)
+        with self._lock:
+            self.records.extend(records)
+            self.counts.extend(counts)
+            for k, v in phases.items():
+                agg = self.phases.setdefault(k, [0.0, 0])
+                agg[0] += v[0]
+                agg[1] += v[1]
+            for k, v in offers.items():
+                agg = self.offers.setdefault(k, [0, 0, 0, 0])
+                for i in range(4):
+                    agg[i] += v[i]
+        pass
+
+    def to_frame(self):
+        columns = ["timestamp", "shop", "product", "phase", "seconds"]
+        return pd.DataFrame(list(self.records), columns=columns)
+
+    def summary(self):
+        # Seconds per shop and phase
+        df = self.to_frame()
+        return df.pivot_table(
+            index="shop", columns="phase", values="seconds", aggfunc="sum"
+        )
+
+    def to_jsonl(self, fp):
+        for t, shop, product, name, seconds in list(self.records):
+            line = {"timestamp": t, "shop": shop, "product": product}
+            line.update({"phase": name, "seconds": seconds})
+            fp.write(json.dumps(line) + "\n")
+        for t, shop, product, found, kept, success in list(self.counts):
+            line = {"timestamp": t, "shop": shop, "product": product}
+            line.update({"found": found, "kept": kept, "success": success})
+            fp.write(json.dumps(line) + "\n")
+        pass
+
+    def to_prometheus(self, prefix="prices_monitor"):
+        def label(v):
+            v = str(v).replace("\\", "\\\\").replace('"', '\\"')
+            return v.replace("\n", "\\n")
+
+        with self._lock:
+            phases, offers = dict(self.phases), dict(self.offers)
+
+        lines = ["# TYPE {}_phase_seconds summary".format(prefix)]
+        for (shop, name), (total, n) in sorted(phases.items()):
+            labels = 'shop="{}",phase="{}"'.format(label(shop), label(name))
+            lines += ["{}_phase_seconds_sum{{{}}} {}".format(prefix, labels, total)]
+            lines += ["{}_phase_seconds_count{{{}}} {}".format(prefix, labels, n)]
+
+        metrics = ["offers_found", "offers_kept"]
+        for i, metric in enumerate(metrics):
+            lines += ["# TYPE {}_{}_total counter".format(prefix, metric)]
+            for shop, agg in sorted(offers.items()):
+                labels = 'shop="{}"'.format(label(shop))
+                lines += ["{}_{}_total{{{}}} {}".format(prefix, metric, labels, agg[i])]
+
+        lines += ["# TYPE {}_queries_total counter".format(prefix)]
+        for shop, agg in sorted(offers.items()):
+            for status, n in [("success", agg[2]), ("failure", agg[3])]:
+                labels = 'shop="{}",status="{}"'.format(label(shop), status)
+                lines += ["{}_queries_total{{{}}} {}".format(prefix, labels, n)]
+        return "\n".join(lines) + "\n"
+
+    pass
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class SearchFailed(Exception):
+    pass
+
+
+class ShopHealth(object):
+
+    # Latency and failures of the browser searches of each shop, kept in
+    # SQLite across runs when a path is given. The driver timeouts are
+    # derived from the p99 latency of the successful searches and a shop
+    # failing threshold times in a row is skipped for cooldown seconds,
+    # then a single probe search decides if it is closed again.
+    schema = """
+    CREATE TABLE IF NOT EXISTS health (
+        shop TEXT NOT NULL,
+        timestamp REAL NOT NULL,
+        elapsed REAL NOT NULL,
+        ok INTEGER NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS health_shop_time ON health (shop, timestamp);
+    """
+
+    def __init__(
+        self,
+        path=None,
+        window=200,
+        min_samples=20,
+        margin=1.5,
+        minimum=3,
+        maximum=30,
+        threshold=5,
+        cooldown=600,
+    ):
+        self.window = window
+        self.min_samples = min_samples
+        self.margin = margin
+        self.minimum = minimum
+        self.maximum = maximum
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.samples = {}
+        # Consecutive failures, time the circuit opened and of the probe
+        self.failures = Counter()
+        self.opened = {}
+        self.probing = {}
+        self.conn = None
+        self._lock = threading.Lock()
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.schema)
+            self.load()
+        pass
+
+    def load(self):
+        sql = """
+        SELECT shop, timestamp, elapsed, ok FROM (
+            SELECT *, ROW_NUMBER() OVER (
+                PARTITION BY shop ORDER BY timestamp DESC
+            ) AS n FROM health
+        ) WHERE n <= ? ORDER BY timestamp
+        """
+        for shop, timestamp, elapsed, ok in self.conn.execute(sql, (self.window,)):
+            self.add(shop, timestamp, elapsed, bool(ok))
+        pass
+
+    def add(self, shop, timestamp, elapsed, ok):
+        if shop not in self.samples:
+            self.samples[shop] = deque(maxlen=self.window)
+        self.samples[shop].append((elapsed, ok))
+        self.probing.pop(shop, None)
+        if ok:
+            self.failures[shop] = 0
+            self.opened.pop(shop, None)
+        else:
+            self.failures[shop] += 1
+            if self.failures[shop] >= self.threshold:
+                self.opened[shop] = timestamp
+        pass
+
+    def record(self, shop, elapsed, ok):
+        timestamp = time.time()
+        with self._lock:
+            self.add(shop, timestamp, elapsed, ok)
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT INTO health VALUES (?, ?, ?, ?)",
+                        (shop, timestamp, elapsed, int(ok)),
+                    )
+        pass
+
+    def latencies(self, shop):
+        return [e for e, ok in self.samples.get(shop, ()) if ok]
+
+    def percentile(self, shop, q=99):
+        latencies = self.latencies(shop)
+        if len(latencies) == 0:
+            return None
+        return float(np.percentile(latencies, q))
+
+    def failure_rate(self, shop):
+        samples = self.samples.get(shop, ())
+        if len(samples) == 0:
+            return None
+        return sum(1 for _, ok in samples if not ok) / len(samples)
+
+    def timeout(self, shop, default=None):
+        # default until min_samples successful searches are known
+        with self._lock:
+            if len(self.latencies(shop)) < self.min_samples:
+                return default
+            p99 = self.percentile(shop, 99)
+        return min(self.maximum, max(self.minimum, p99 * self.margin))
+
+    def allow(self, shop):
+        with self._lock:
+            opened = self.opened.get(shop)
+            if opened is None:
+                return True
+            now = time.time()
+            if now - opened < self.cooldown:
+                return False
+            # Half open, a single probe until it is recorded or it also
+            # takes longer than the cooldown
+            probe = self.probing.get(shop)
+            if probe is not None and now - probe < self.cooldown:
+                return False
+            self.probing[shop] = now
+            return True
+
+    def summary(self):
+        out = []
+        for shop in sorted(self.samples):
+            out += [
+                {
+                    "shop": shop,
+                    "samples": len(self.samples[shop]),
+                    "p50": self.percentile(shop, 50),
+                    "p99": self.percentile(shop, 99),
+                    "failure_rate": self.failure_rate(shop),
+                    "timeout": self.timeout(shop),
+                    "open": shop in self.opened,
+                }
+            ]
+        return pd.DataFrame.from_dict(out)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        pass
+
+    pass
+
+
 class ShopDriver(object):
 
+    shop = "Shop Driver"
     link = "https://www.shopdriver.io/"
     locale = "pt_BR"
     currency = "BRL"
 
     timed_out = 10
 
-    def __init__(self, browser):
+    # Readiness conditions waited before reading the grid, the wait stops
+    # early when the not_found marker is present. ready_timeout is the shop
+    # deadline, timed_out is used when it is None.
+    ready = ()
+    not_found = None
+    ready_timeout = None
+
+    # Extract the products with a single script call instead of one
+    # WebDriver call per product and field
+    js_extract = True
+
+    # Resources the shop needs to render its grid with the lean profile,
+    # see lean_preferences
+    lean_allow = ()
+
+    # HTTP fetch backend, a driver supports it by declaring the search url
+    # ("{link}" and "{query}" are replaced) and the CSS selectors of the grid
+    search_url = None
+    fetch_grid = None
+    fetch_item = None
+    fetch_fields = {}
+
+    # Pagination: page_url is the search url of the following pages for the
+    # HTTP backend ("{page}" and "{offset}" are also replaced) and next_page
+    # the locator of the results next page button
+    page_url = None
+    page_size = 24
+    next_page = None
+
+    def __init__(
+        self,
+        browser,
+        fetcher=None,
+        reuse_page=False,
+        cache=None,
+        browser_factory=None,
+        metrics=None,
+        health=None,
+    ):
+        # browser_factory is called on the first Selenium fallback when the
+        # driver was created without a browser. With a ShopHealth the waits
+        # use the timeout observed for the shop.
+        self.metrics = metrics
+        self.health = health
+        if health is not None:
+            self.timed_out = health.timeout(self.shop, self.timed_out)
+            if self.ready_timeout is not None:
+                self.ready_timeout = health.timeout(self.shop, self.ready_timeout)
+        self.query = None
+        self.fetcher = fetcher
+        self.reuse_page = reuse_page
+        self.reused_page = None
+        self.cache = cache
+        self.browser_factory = browser_factory
+        self.browser = None
+        self.wait = None
+        self.backend = None
+        # Last scan_search error and whether the last search failed, a
+        # search without offers is only a failure when it raised and the
+        # shop did not show its not found marker
+        self.error = None
+        self.failed = False
+        self.page = 1
+        if browser is not None:
+            self.attach(browser)
+        pass
+
+    def attach(self, browser):
         self.browser = browser
         self.wait = WebDriverWait(browser, self.timed_out)
         pass
 
-    def get_product(self, product, exclude=[], include=[], or_include=False):
-        self.search(product)
-        data, success = self.scan_search()
-        if success:
-            data = filter_products(product, data, exclude, include, or_include)
-            return data
-        else:
+    def get_product(
+        self,
+        product,
+        exclude=[],
+        include=[],
+        or_include=False,
+        max_pages=1,
+        limit=None,
+    ):
+        # Reads up to max_pages result pages and stops early once limit
+        # offers passed the filters or a page has no match
+        self.query = product
+        out = []
+        found = 0
+        success = False
+        with self.timer("total"):
+            for data in self.iter_pages(product, max_pages):
+                success = True
+                found += len(data)
+                with self.timer("filter"):
+                    kept = filter_products(product, data, exclude, include, or_include)
+                for o in kept:
+                    o["product"] = product
+                out += kept
+                if len(kept) == 0 or (limit is not None and len(out) >= limit):
+                    break
+        if limit is not None:
+            out = out[:limit]
+        if self.metrics is not None:
+            self.metrics.count(self.shop, product, found, len(out), success)
+        return out
+
+    def iter_pages(self, product, max_pages=1):
+        # Lazily yields the unfiltered offers of each result page, the next
+        # page is only loaded when the caller asks for it. Offers of the
+        # previous pages are dropped and the paging stops on a page with no
+        # new offer, e.g. a shop serving the last page again.
+        data, success = self.search_offers(product)
+        if not success:
+            return
+        seen = set((o["info"], o["price"]) for o in data)
+        yield data
+
+        for page in range(2, max_pages + 1):
+            data, success = self.page_offers(product, page)
+            if not success:
+                return
+            data = [o for o in data if (o["info"], o["price"]) not in seen]
+            if len(data) == 0:
+                return
+            seen.update((o["info"], o["price"]) for o in data)
+            yield data
+
+    def page_offers(self, product, page):
+        # Following pages are not cached, they use the page url of the HTTP
+        # backend or the next page button of the search results
+        if self.page_url is not None and self.backend != "browser":
+            with self.timer("fetch"):
+                data, success = self.fetch_search(product, page)
+            if success or self.next_page is None:
+                return data, success
+
+        if self.next_page is None:
+            return [], False
+        if self.browser is None and self.browser_factory is not None:
+            self.attach(self.browser_factory())
+        if self.browser is None:
+            return [], False
+
+        # Results page not open, e.g. first page from the cache
+        if self.backend != "browser" or self.page != page - 1:
+            self.recycle_browser()
+            for p in range(1, page):
+                if p == 1:
+                    with self.timer("search"):
+                        self.search(product)
+                    data, success = self.scan_search()
+                else:
+                    data, success = self.scan_next_page()
+                if not success:
+                    return [], False
+            self.backend = "browser"
+
+        data, success = self.scan_next_page()
+        self.page = page
+        return data, success
+
+    def scan_next_page(self):
+        browser = self.browser
+        buttons = browser.find_elements(*self.next_page)
+        if len(buttons) == 0:
+            return [], False
+
+        current = browser.find_element_by_tag_name("html")
+        with self.timer("search"):
+            buttons[0].click()
+            try:
+                self.wait.until(ec.staleness_of(current))
+            except exceptions.TimeoutException:
+                pass
+        return self.scan_search()
+
+    def recycle_browser(self):
+        # Nothing of the previous search is used after this point, a
+        # RecyclingBrowser may close the stray tabs or restart here
+        recycle = getattr(self.browser, "recycle", None)
+        if recycle is not None:
+            recycle()
+        pass
+
+    def timer(self, phase):
+        if self.metrics is None:
+            return nullcontext()
+        return self.metrics.phase(self.shop, self.query, phase)
+
+    def search_offers(self, product):
+        # Unfiltered offers of a search, filters are applied after the cache
+        self.query = product
+        self.page = 1
+        if self.cache is not None:
+            with self.timer("cache"):
+                data = self.cache.get(self.shop, product, self.locale)
+            if data is not None:
+                self.backend = "cache"
+                return data, True
+
+        # Try the HTTP backend first and fall back to Selenium
+        self.backend = "fetch"
+        self.failed = False
+        with self.timer("fetch"):
+            data, success = self.fetch_search(product)
+        if not success and self.browser is None and self.browser_factory is not None:
+            self.attach(self.browser_factory())
+        if not success and self.browser is not None:
+            self.backend = "browser"
+            self.recycle_browser()
+            self.error = None
+            start = time.perf_counter()
+            self.failed = True
+            try:
+                with self.timer("search"):
+                    self.search(product)
+                data, success = self.scan_search()
+                self.failed = not success and self.error is not None
+                if self.failed and self.shows_not_found():
+                    self.failed = False
+            finally:
+                # Products the shop does not sell are not failures
+                if self.health is not None:
+                    elapsed = time.perf_counter() - start
+                    self.health.record(self.shop, elapsed, not self.failed)
+        elif not success:
+            # No backend could run the search
+            self.failed = True
+
+        if success and self.cache is not None:
+            self.cache.set(self.shop, product, self.locale, data)
+        return data, success
+
+    def scan_failed(self, error):
+        # Called by scan_search when it could not read the results page
+        print("Fail to find the products container!")
+        print(error)
+        self.error = error
+        pass
+
+    def shows_not_found(self):
+        if self.not_found is None or self.browser is None:
+            return False
+        try:
+            return bool(self.not_found.check(self.browser, {}))
+        except Exception:
+            return False
+
+    def search_box(self, by, value):
+        browser = self.browser
+        # Reuse the search bar of the page already open on the shop, it
+        # saves the homepage load between queries
+        self.reused_page = None
+        if self.reuse_page:
+            if urlparse(browser.current_url).netloc == urlparse(self.link).netloc:
+                search = browser.find_elements(by, value)
+                if len(search) > 0:
+                    self.reused_page = browser.find_element_by_tag_name("html")
+                    search[0].clear()
+                    return search[0]
+
+        # Open shop link
+        browser.get(self.link)
+        return browser.find_element(by, value)
+
+    def submit_search(self, search, product):
+        search.send_keys(product)
+        search.send_keys(Keys.ENTER)
+        # Do not read the previous results while the new page loads
+        if self.reused_page is not None:
+            try:
+                self.wait.until(ec.staleness_of(self.reused_page))
+            except exceptions.TimeoutException:
+                pass
+            self.reused_page = None
+        pass
+
+    def wait_ready(self):
+        timeout = self.timed_out if self.ready_timeout is None else self.ready_timeout
+        waiter = ReadyWait(self.browser, self.shop, timeout)
+        with self.timer("wait"):
+            for condition in self.ready:
+                if not waiter.until(condition, self.not_found):
+                    return False
+        return True
+
+    def wait_until(self, condition):
+        with self.timer("wait"):
+            return self.wait.until(condition)
+
+    def extract(self, grid, class_name=None, id_val=None):
+        with self.timer("extract"):
+            return extract_products(grid, class_name, id_val, self.timed_out)
+
+    def craw(self, items, class_name={}, id_val={}):
+        browser = self.browser if self.js_extract else None
+        with self.timer("crawl"):
+            return craw_products(items, class_name, id_val, browser=browser)
+
+    def detail(self, price, info=None, shop=None, **kwargs):
+        with self.timer("parse"):
+            return create_prod_detail(
+                price, info, shop, self.locale, self.currency, **kwargs
+            )
+
+    def fetch_search(self, product, page=1):
+        url = self.search_url if page == 1 else self.page_url
+        if self.fetcher is None or url is None:
+            return [], False
+
+        url = url.format(
+            link=self.link,
+            query=quote(product, safe=""),
+            page=page,
+            offset=(page - 1) * self.page_size,
+        )
+        try:
+            out = self.parse_search(self.fetcher.get(url))
+        except Exception as e:
+            print("Fail to fetch the products page!")
+            print(e)
+            out = []
+
+        success = True if len(out) > 0 else False
+        return out, success
+
+    def parse_search(self, html):
+        soup = BeautifulSoup(html, "lxml")
+
+        # Get grid
+        grid = soup if self.fetch_grid is None else soup.select_one(self.fetch_grid)
+        if grid is None:
             return []
 
+        # Scan products, incomplete items are kept as empty dicts
+        items = []
+        for p in grid.select(self.fetch_item):
+            aux = {}
+            for k, selector in self.fetch_fields.items():
+                tmp = p.select_one(selector)
+                if tmp is None:
+                    aux = {}
+                    break
+                aux[k] = tmp.get_text(" ", strip=True)
+            items += [aux]
+
+        return self.detail(items, shop=self.shop)
+
     pass
 
 
@@ -176,104 +2138,132 @@ class GoogleShopDriver(ShopDriver):
 
     timed_out = 10
 
+    next_page = (By.ID, "pnnext")
+
     def search(self, product):
-        browser = self.browser
-        link = self.link
         # id for search bar
         search_id = "gLFyf"
 
-        # Open shop link
-        browser.get(link)
-
-        # Search product
-        search = browser.find_element_by_class_name(search_id)
-        search.send_keys(product)
-        search.send_keys(Keys.ENTER)
+        # Open shop link and search product
+        search = self.search_box(By.CLASS_NAME, search_id)
+        self.submit_search(search, product)
         pass
 
+    # Reads every grid product once: title, comparison page link and the
+    # price and shop of the products without comparison
+    grid_script = """
+    var products = arguments[0];
+    function text(p, name) {
+        var el = p.getElementsByClassName(name)[0];
+        return el ? el.innerText.trim() : null;
+    }
+    return products.map(function (p) {
+        var compare = p.getElementsByClassName("C1iIFb")[0], link = null;
+        if (compare) {
+            var a = compare.closest("a") || compare.querySelector("a");
+            link = a ? a.href : null;
+        }
+        return {
+            title: text(p, "xsRiS"),
+            compare: link,
+            price: text(p, "Nr22bf"),
+            shop: text(p, "shntl")
+        };
+    });
+    """
+
     def scan_search(self):
 
         # Procedure:
         # 1. Find the product grid: "sh-pr__product-results"
         # 2. Get the grid products: "sh-dlr__list-result"
-        # 3. Get product(s) prices and information
-        #   * Price: "sc-fznWqX"
+        # 3. Read all the products in one pass
         #   * Info: "xsRiS"
-        # 4. Return info
+        #   * Compare link: "C1iIFb"
+        #   * Price and shop when there is no comparison: "Nr22bf", "shntl"
+        # 4. Crawl the comparison pages in a separate tab
+        # 5. Return info
 
-        def scan_grid():
-            # Wait to "memu-products-container" to load
+        browser = self.browser
+        presence_of = ec.presence_of_element_located
+
+        try:
+            # Wait to "sh-pr__product-results" to load
             grid_val = "sh-pr__product-results"
-            wait.until(presence_of((By.CLASS_NAME, grid_val)))
+            self.wait_until(presence_of((By.CLASS_NAME, grid_val)))
             # Get grid
             grid = browser.find_elements_by_class_name(grid_val)
-            products = extract_products(grid[0], class_name="sh-dlr__list-result")
-            return products
+            products = self.extract(grid[0], class_name="sh-dlr__list-result")
 
-        browser = self.browser
-        wait = self.wait
-        locale = self.locale
-        presence_of = ec.presence_of_element_located
+            with self.timer("crawl"):
+                items = browser.execute_script(self.grid_script, products)
 
-        # wait = WebDriverWait(browser, timed_out)
-        try:
-            # Scan products
+            # Each product is handled once, duplicated titles included
             out = []
+            compare = []
+            for item in items:
+                if item["title"] is None:
+                    continue
+                if item["compare"] is not None:
+                    compare += [(item["title"], item["compare"])]
+                elif item["price"] is not None and item["shop"] is not None:
+                    price = [{"price": item["price"], "shop": item["shop"]}]
+                    out += self.detail(price, item["title"])
 
-            # Initial product scan to get the product titles
-            products = scan_grid()
+            out += self.scan_comparisons(compare)
 
-            # Build a list with
-            lst_title = []
-            for p in products:
-                # Get info
-                title = p.find_elements_by_class_name("xsRiS")[0].text
-                lst_title += [title]
-
-            while len(lst_title) > 0:
-                for p in products:
-                    # Get info
-                    title = p.find_elements_by_class_name("xsRiS")[0].text
-                    if title in lst_title:
-                        lst_title.remove(title)
-                    else:
-                        continue
+            success = True if len(out) > 0 else False
+        except Exception as e:
+            self.scan_failed(e)
+            out = []
+            success = False
 
-                    # Get price
-                    compare_class = "C1iIFb"
-                    comp_btt = p.find_elements_by_class_name(compare_class)
-                    if len(comp_btt) > 0:
-                        # browser.execute_script("arguments[0].scrollIntoView(true);", comp_btt[0])
-                        comp_btt[0].click()
-                        # Get table of shops
-                        table_id = "sh-osd__online-sellers-cont"
-                        table = browser.find_elements_by_id(table_id)
+        return out, success
 
-                        table_shops = "sh-osd__offer-row"
-                        t_shops = extract_products(table[0], class_name=table_shops)
+    def scan_comparisons(self, compare):
+        # The comparison pages are opened in an extra tab, the results page
+        # is never navigated away and does not need to be scanned again
+        if len(compare) == 0:
+            return []
 
-                        class_name = {"shop": "sh-osd__seller-link", "price": "QXiyfd"}
-                        price = craw_products(t_shops, class_name=class_name)
+        browser = self.browser
+        results = browser.current_window_handle
+        handles = browser.window_handles
+        browser.execute_script("window.open('about:blank');")
+        tab = [h for h in browser.window_handles if h not in handles][0]
+        browser.switch_to.window(tab)
 
-                    else:
-                        class_name = {"price": "Nr22bf", "shop": "shntl"}
-                        price = craw_products([p], class_name=class_name)
+        out = []
+        try:
+            for title, link in compare:
+                try:
+                    out += self.scan_comparison(title, link)
+                except Exception as e:
+                    print("Fail to scan the comparison of {}!".format(title))
+                    print(e)
+        finally:
+            browser.close()
+            browser.switch_to.window(results)
+        return out
+
+    def scan_comparison(self, title, link):
+        browser = self.browser
+        presence_of = ec.presence_of_element_located
 
-                    out += create_prod_detail(price, title, locale=locale)
+        with self.timer("search"):
+            browser.get(link)
 
-                    if len(comp_btt) > 0:
-                        browser.execute_script("window.history.go(-1)")
-                        products = scan_grid()
-                        break
+        # Get table of shops
+        table_id = "sh-osd__online-sellers-cont"
+        self.wait_until(presence_of((By.ID, table_id)))
+        table = browser.find_elements_by_id(table_id)
 
-            success = True if len(out) > 0 else False
-        except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
-            out = []
-            success = False
+        table_shops = "sh-osd__offer-row"
+        t_shops = self.extract(table[0], class_name=table_shops)
 
-        return out, success
+        class_name = {"shop": "sh-osd__seller-link", "price": "QXiyfd"}
+        price = self.craw(t_shops, class_name=class_name)
+        return self.detail(price, title)
 
     pass
 
@@ -287,25 +2277,24 @@ class AmazonDriver(ShopDriver):
 
     timed_out = 10
 
+    search_url = "{link}s?k={query}"
+    page_url = "{link}s?k={query}&page={page}"
+    next_page = (By.CLASS_NAME, "s-pagination-next")
+    fetch_grid = ".s-main-slot"
+    fetch_item = ".celwidget"
+    fetch_fields = {"price": ".a-price .a-offscreen", "info": ".a-size-medium"}
+
     def search(self, product):
-        browser = self.browser
-        link = self.link
         # id for search bar
         search_id = "twotabsearchtextbox"
 
-        # Open shop link
-        browser.get(link)
-
-        # Search product
-        search = browser.find_element_by_id(search_id)
-        search.send_keys(product)
-        search.send_keys(Keys.ENTER)
+        # Open shop link and search product
+        search = self.search_box(By.ID, search_id)
+        self.submit_search(search, product)
         pass
 
     def scan_search(self):
         browser = self.browser
-        wait = self.wait
-        locale = self.locale
         presence_of = ec.presence_of_element_located
 
         # wait = WebDriverWait(browser, timed_out)
@@ -321,23 +2310,20 @@ class AmazonDriver(ShopDriver):
         try:
             # Wait to "memu-products-container" to load
             grid_val = "s-main-slot"
-            wait.until(presence_of((By.CLASS_NAME, grid_val)))
+            self.wait_until(presence_of((By.CLASS_NAME, grid_val)))
             # Get grid
             grid = browser.find_elements_by_class_name(grid_val)
 
-            products = extract_products(grid[0], class_name="celwidget")
+            products = self.extract(grid[0], class_name="celwidget")
 
             # Scan products
             class_name = {"price": "a-price", "info": "a-size-medium"}
-            price = craw_products(products, class_name=class_name)
-            out = create_prod_detail(
-                price, shop=self.shop, locale=locale, replace=["\n", ","]
-            )
+            price = self.craw(products, class_name=class_name)
+            out = self.detail(price, shop=self.shop, replace=["\n", ","])
 
             success = True if len(out) > 0 else False
         except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -355,25 +2341,23 @@ class MagaLuDriver(ShopDriver):
 
     timed_out = 10
 
+    ready = (
+        GridSettled(".neemu-products-container .nm-product-item"),
+        PricesPopulated(".nm-product-item .nm-price-container"),
+    )
+    not_found = NotFound(".nm-not-found-container")
+
     def search(self, product):
-        browser = self.browser
-        link = self.link
         # id for search bar
-        search_id = "inpHeaderSearch"
-
-        # Open shop link
-        browser.get(link)
+        search_id = "inpHeaderSearch"
 
-        # Search product
-        search = browser.find_element_by_id(search_id)
-        search.send_keys(product)
-        search.send_keys(Keys.ENTER)
+        # Open shop link and search product
+        search = self.search_box(By.ID, search_id)
+        self.submit_search(search, product)
         pass
 
     def scan_search(self):
         browser = self.browser
-        wait = self.wait
-        locale = self.locale
         presence_of = ec.presence_of_element_located
 
         # Procedure:
@@ -392,22 +2376,24 @@ class MagaLuDriver(ShopDriver):
 
             # Wait to "memu-products-container" to load
             grid_val = "neemu-products-container"
-            wait.until(presence_of((By.CLASS_NAME, grid_val)))
+            self.wait_until(presence_of((By.CLASS_NAME, grid_val)))
             # Get grid
             grid = browser.find_elements_by_class_name(grid_val)
 
-            products = extract_products(grid[0], class_name="nm-product-item")
+            # Wait the grid to settle
+            if not self.wait_ready():
+                raise Exception("I cannot find the product requested")
+
+            products = self.extract(grid[0], class_name="nm-product-item")
 
             # Scan products
-            time.sleep(3)
             class_name = {"price": "nm-price-container", "info": "nm-product-name"}
-            price = craw_products(products, class_name=class_name)
-            out = create_prod_detail(price, shop=self.shop, locale=locale)
+            price = self.craw(products, class_name=class_name)
+            out = self.detail(price, shop=self.shop)
 
             success = True if len(out) > 0 else False
         except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -474,8 +2460,7 @@ class MagaLuDriver(ShopDriver):
 
             success = True if len(out) > 0 else False
         except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -493,25 +2478,29 @@ class KabumDriver(ShopDriver):
 
     timed_out = 10
 
+    ready = (
+        GridSettled("#listagem-produtos .sc-fzqNqU"),
+        PricesPopulated("#listagem-produtos .sc-fznWqX"),
+    )
+    not_found = NotFound(".sc-fzomME")
+
+    search_url = "{link}cgi-local/site/listagem/listagem.cgi?string={query}"
+    page_url = search_url + "&pagina={page}"
+    fetch_grid = "#listagem-produtos"
+    fetch_item = ".sc-fzqNqU"
+    fetch_fields = {"price": ".sc-fznWqX", "info": ".sc-fzoLsD"}
+
     def search(self, product):
-        browser = self.browser
-        link = self.link
         # id for search bar
         search_id = "sprocura"
 
-        # Open shop link
-        browser.get(link)
-
-        # Search product
-        search = browser.find_element_by_class_name(search_id)
-        search.send_keys(product)
-        search.send_keys(Keys.ENTER)
+        # Open shop link and search product
+        search = self.search_box(By.CLASS_NAME, search_id)
+        self.submit_search(search, product)
         pass
 
     def scan_search(self):
         browser = self.browser
-        wait = self.wait
-        locale = self.locale
         presence_of = ec.presence_of_element_located
 
         # wait = WebDriverWait(browser, timed_out)
@@ -527,7 +2516,7 @@ class KabumDriver(ShopDriver):
         try:
             # Wait to "listagem-produtos" to load
             grid_val = "listagem-produtos"
-            wait.until(presence_of((By.ID, grid_val)))
+            self.wait_until(presence_of((By.ID, grid_val)))
             # Get grid
             grid = browser.find_elements_by_id(grid_val)
 
@@ -536,18 +2525,20 @@ class KabumDriver(ShopDriver):
             if len(not_found) > 0:
                 raise "I cannot find the product requested"
 
-            products = extract_products(grid[0], class_name="sc-fzqNqU")
+            # Wait the grid to settle
+            if not self.wait_ready():
+                raise Exception("I cannot find the product requested")
+
+            products = self.extract(grid[0], class_name="sc-fzqNqU")
 
-            time.sleep(3)
             # Scan products
             class_name = {"price": "sc-fznWqX", "info": "sc-fzoLsD"}
-            price = craw_products(products, class_name=class_name)
-            out = create_prod_detail(price, shop=self.shop, locale=locale)
+            price = self.craw(products, class_name=class_name)
+            out = self.detail(price, shop=self.shop)
 
             success = True if len(out) > 0 else False
         except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -565,26 +2556,23 @@ class B2WDriver(ShopDriver):
 
     timed_out = 10
 
+    search_url = "{link}busca/{query}"
+    page_url = "{link}busca/{query}?limite=24&offset={offset}"
+    fetch_grid = ".main-grid"
+    fetch_item = ".product-grid-item"
+    fetch_fields = {"price": 'span[class*="Price"]', "info": 'h2[class*="TitleUI"]'}
+
     def search(self, product):
-        browser = self.browser
-        link = self.link
         # id for search bar
         search_id = "h_search-input"
 
-        # Open shop link
-        browser.get(link)
-
-        # Search product
-        search = browser.find_element_by_id(search_id)
-        search.send_keys(product)
-        search.send_keys(Keys.ENTER)
+        # Open shop link and search product
+        search = self.search_box(By.ID, search_id)
+        self.submit_search(search, product)
         pass
 
     def scan_search(self):
         browser = self.browser
-        wait = self.wait
-        locale = self.locale
-        shop = self.shop
 
         presence_of = ec.presence_of_element_located
 
@@ -593,42 +2581,24 @@ class B2WDriver(ShopDriver):
         # 1. Find the product grid: "main-grid"
         # 2. Get the grid products: "product-grid-item"
         # 3. Get product(s) prices and information
-        #   * Price: Beautiful soup ->  'span', {'class' : re.compile("Price")}
-        #   * Info: Beautiful soup ->  'h2', {'class' : re.compile("TitleUI")}
+        #   * Price: Beautiful soup ->  'span[class*="Price"]'
+        #   * Info: Beautiful soup ->  'h2[class*="TitleUI"]'
         # 4. Return info
 
-        # Regex search
-
-        re_price = re.compile("Price")
-        re_info = re.compile("TitleUI")
-
         # Wait to "main-grid" to load
         try:
-            wait.until(presence_of((By.CLASS_NAME, "main-grid")))
+            self.wait_until(presence_of((By.CLASS_NAME, "main-grid")))
             grid = browser.find_elements_by_class_name("main-grid")
 
-            products = extract_products(grid[0], class_name="product-grid-item")
-
-            # Scan products
-            out = []
-            for p in products:
-                # Parse the html
-                soup = BeautifulSoup(p.get_attribute("outerHTML"))
-                # Find the product price and info
-                price = soup.find_all("span", {"class": re_price})
-                title = soup.find_all("h2", {"class": re_info})
-
-                # Check for empty info
-                if len(price) == 0:
-                    continue
-                if len(title) == 0:
-                    continue
+            # Wait the grid products
+            self.extract(grid[0], class_name="product-grid-item")
 
-                # Append item
-                out += create_prod_detail(price[0].text, title[0].text, shop, locale)
+            # Parse the whole grid html at once
+            out = self.parse_search(grid[0].get_attribute("outerHTML"))
 
             success = True if len(out) > 0 else False
-        except:
+        except Exception as e:
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -683,6 +2653,14 @@ class PaoAcucarDriver(ShopDriver):
 
     timed_out = 10
 
+    ready = (
+        GridSettled(".ProductCard__ProductContainer-sc-2vuvzo-3"),
+        PricesPopulated(
+            ".ProductCard__ProductContainer-sc-2vuvzo-3 .ProductPrice__Price-sc-1tzw2we-3"
+        ),
+    )
+    not_found = NotFound(".Container-ylum0o-0.pages__Main-sc-4fgpoh-1")
+
     def search(self, product):
         browser = self.browser
         link = self.link
@@ -714,8 +2692,6 @@ class PaoAcucarDriver(ShopDriver):
 
     def scan_search(self):
         browser = self.browser
-        wait = self.wait
-        locale = self.locale
         presence_of = ec.presence_of_element_located
 
         # wait = WebDriverWait(browser, timed_out)
@@ -730,35 +2706,34 @@ class PaoAcucarDriver(ShopDriver):
 
         try:
             # Check it was found something or not and wait
-            not_found = browser.find_elements_by_class_name(
-                "Container-ylum0o-0 pages__Main-sc-4fgpoh-1"
-            )
-            if len(not_found) > 0:
-                raise "I cannot find the product requested"
+            if self.shows_not_found():
+                raise Exception("I cannot find the product requested")
 
             # Wait to "ProductsGrid__ProductsGridWrapper-yqpqna-0" to load
             product_grid = "ProductsGrid__ProductsGridWrapper-yqpqna-0"
-            wait.until(presence_of((By.CLASS_NAME, product_grid)))
+            self.wait_until(presence_of((By.CLASS_NAME, product_grid)))
             # Get grid
             grid = browser.find_elements_by_class_name(product_grid)
 
+            # Wait the grid to settle
+            if not self.wait_ready():
+                raise Exception("I cannot find the product requested")
+
             # Get grid products
             class_name = "ProductCard__ProductContainer-sc-2vuvzo-3"
-            products = extract_products(grid[0], class_name=class_name)
+            products = self.extract(grid[0], class_name=class_name)
 
-            time.sleep(3)
             # Scan products
             class_name = {
                 "price": "ProductPrice__Price-sc-1tzw2we-3",
                 "info": "ProductCard__Title-sc-2vuvzo-0",
             }
-            price = craw_products(products, class_name=class_name)
-            out = create_prod_detail(price, shop=self.shop, locale=locale)
+            price = self.craw(products, class_name=class_name)
+            out = self.detail(price, shop=self.shop)
 
             success = True if len(out) > 0 else False
         except Exception as e:
-            print("Fail to find the products container!")
-            print(e)
+            self.scan_failed(e)
             out = []
             success = False
 
@@ -792,9 +2767,726 @@ class CasasBahiaDriver(PaoAcucarDriver):
     pass
 
 
+class ResultCache(object):
+
+    # LRU cache of the unfiltered offers per (shop, query, locale) with per
+    # shop TTLs and an optional SQLite tier that survives restarts. The
+    # SQLite tier drops the expired rows and keeps the disk_maxsize rows
+    # expiring last, 10 times maxsize by default.
+    schema = """
+    CREATE TABLE IF NOT EXISTS results (
+        key TEXT PRIMARY KEY,
+        expires REAL NOT NULL,
+        offers TEXT NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS results_expires ON results (expires);
+    """
+
+    def __init__(self, maxsize=1024, ttl=600, ttls={}, path=None, disk_maxsize=None):
+        self.maxsize = maxsize
+        self.disk_maxsize = 10 * maxsize if disk_maxsize is None else disk_maxsize
+        self.ttl = ttl
+        self.ttls = dict(ttls)
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.conn = None
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.executescript(self.schema)
+        pass
+
+    @staticmethod
+    def key(shop, product, locale):
+        query = " ".join(unidecode.unidecode(product).lower().split())
+        return json.dumps([shop, query, locale])
+
+    def get(self, shop, product, locale="pt_BR"):
+        key = self.key(shop, product, locale)
+        now = time.time()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] <= now:
+                del self._data[key]
+                item = None
+            if item is None and self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT expires, offers FROM results WHERE key = ? AND expires > ?",
+                    (key, now),
+                ).fetchone()
+                if row is not None:
+                    offers = [Offer.from_mapping(o) for o in json.loads(row[1])]
+                    item = (row[0], offers)
+                    self._store(key, item)
+                    self.disk_hits += 1
+            if item is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+        # Copies, callers may change the offers
+        return [o.copy() for o in item[1]]
+
+    def set(self, shop, product, locale, offers):
+        key = self.key(shop, product, locale)
+        expires = time.time() + self.ttls.get(shop, self.ttl)
+        offers = [Offer.from_mapping(o) for o in offers]
+        with self._lock:
+            self._store(key, (expires, offers))
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute(
+                        "INSERT OR REPLACE INTO results VALUES (?, ?, ?)",
+                        (key, expires, json.dumps([o.to_dict() for o in offers])),
+                    )
+                    self._purge()
+        pass
+
+    def _purge(self):
+        self.conn.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+        (size,) = self.conn.execute("SELECT COUNT(*) FROM results").fetchone()
+        if size > self.disk_maxsize:
+            self.conn.execute(
+                """
+                DELETE FROM results WHERE key IN (
+                    SELECT key FROM results ORDER BY expires LIMIT ?
+                )
+                """,
+                (size - self.disk_maxsize,),
+            )
+        pass
+
+    def _store(self, key, item):
+        self._data[key] = item
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        pass
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute("DELETE FROM results")
+        pass
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "size": len(self._data),
+        }
+
+    pass
+
+
+def to_epoch(value):
+    # Accepts epoch seconds, datetime or ISO strings
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+class PriceStore(object):
+
+    # Append-only price history in SQLite, one row per offer and scan
+    schema = """
+    CREATE TABLE IF NOT EXISTS prices (
+        id INTEGER PRIMARY KEY,
+        product TEXT NOT NULL,
+        shop TEXT,
+        info TEXT,
+        price REAL,
+        currency TEXT,
+        timestamp REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS prices_product_shop_time
+        ON prices (product, shop, timestamp);
+    CREATE INDEX IF NOT EXISTS prices_product_time_price
+        ON prices (product, timestamp, price);
+    """
+    columns = ["product", "shop", "info", "price", "currency", "timestamp"]
+
+    def __init__(self, path="prices.db"):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.schema)
+        self._lock = threading.Lock()
+        pass
+
+    def add(self, offers, product=None, timestamp=None, currency="BRL"):
+        # Bulk insert of a whole scan in a single transaction
+        df = offers_frame(offers).copy(deep=False)
+        if len(df) == 0:
+            return 0
+        timestamp = time.time() if timestamp is None else to_epoch(timestamp)
+        defaults = {
+            "product": product,
+            "shop": None,
+            "info": None,
+            "currency": currency,
+            "timestamp": timestamp,
+        }
+        for k, v in defaults.items():
+            if k not in df.columns:
+                df[k] = v
+            elif v is not None:
+                df[k] = df[k].where(df[k].notna(), v)
+        df["timestamp"] = df["timestamp"].map(to_epoch)
+
+        rows = df[self.columns].astype(object).where(df[self.columns].notna(), None)
+        sql = "INSERT INTO prices ({}) VALUES (?, ?, ?, ?, ?, ?)"
+        with self._lock, self.conn:
+            self.conn.executemany(
+                sql.format(", ".join(self.columns)), rows.itertuples(index=False)
+            )
+        return len(rows)
+
+    def query(self, sql, params=()):
+        df = pd.read_sql_query(sql, self.conn, params=params)
+        if "timestamp" in df.columns:
+            df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s", utc=True)
+        return df
+
+    def latest(self, product):
+        # Cheapest offer of the last scan of each shop
+        sql = """
+        SELECT p.shop, p.info, MIN(p.price) AS price, p.currency, p.timestamp
+        FROM prices p
+        JOIN (
+            SELECT shop, MAX(timestamp) AS timestamp FROM prices
+            WHERE product = ? GROUP BY shop
+        ) l ON p.shop = l.shop AND p.timestamp = l.timestamp
+        WHERE p.product = ?
+        GROUP BY p.shop
+        ORDER BY price
+        """
+        return self.query(sql, (product, product))
+
+    def history(self, product, shop=None, start=None, end=None):
+        sql = "SELECT * FROM prices WHERE product = ?"
+        params = [product]
+        if shop is not None:
+            sql += " AND shop = ?"
+            params += [shop]
+        sql, params = self._window(sql, params, start, end)
+        return self.query(sql + " ORDER BY timestamp", params)
+
+    def cheapest(self, product, start=None, end=None, n=1):
+        sql = "SELECT * FROM prices WHERE product = ? AND price IS NOT NULL"
+        sql, params = self._window(sql, [product], start, end)
+        return self.query(sql + " ORDER BY price LIMIT ?", params + [n])
+
+    def _window(self, sql, params, start, end):
+        if start is not None:
+            sql += " AND timestamp >= ?"
+            params += [to_epoch(start)]
+        if end is not None:
+            sql += " AND timestamp < ?"
+            params += [to_epoch(end)]
+        return sql, params
+
+    def close(self):
+        self.conn.close()
+        pass
+
+    pass
+
+
+class PriceEvent(object):
+
+    # Change of an offer between two scans: "new", "removed", "up" or "down".
+    # previous and low are the last and the all-time lowest known prices,
+    # change the relative price change. alerts holds the rules fired.
+    def __init__(
+        self,
+        kind,
+        product,
+        shop,
+        info,
+        price=None,
+        previous=None,
+        low=None,
+        timestamp=None,
+    ):
+        self.kind = kind
+        self.product = product
+        self.shop = shop
+        self.info = info
+        self.price = price
+        self.previous = previous
+        self.low = low
+        self.timestamp = timestamp
+        self.change = None
+        if price is not None and previous:
+            self.change = (price - previous) / previous
+        self.alerts = []
+        pass
+
+    def to_dict(self):
+        out = dict(vars(self))
+        out["alerts"] = [a.name for a in self.alerts]
+        return out
+
+    def __repr__(self):
+        return "PriceEvent({}, {!r}, {!r}, {!r}, {} -> {})".format(
+            self.kind, self.product, self.shop, self.info, self.previous, self.price
+        )
+
+    pass
+
+
+class AlertRule(object):
+
+    # Rules evaluated on each PriceEvent, check returns True to fire
+    name = "alert"
+    kinds = ("new", "up", "down")
+
+    def __init__(self, product=None):
+        # Restricts the rule to a product
+        self.product = product
+        pass
+
+    def applies(self, event):
+        if event.kind not in self.kinds:
+            return False
+        return self.product is None or self.product == event.product
+
+    def check(self, event):
+        raise NotImplementedError
+
+    pass
+
+
+class AllTimeLow(AlertRule):
+
+    # Price below every price known of the offer
+    name = "all_time_low"
+    kinds = ("down", "new")
+
+    def check(self, event):
+        return event.low is not None and event.price < event.low
+
+
+class BelowPrice(AlertRule):
+    name = "below_price"
+
+    def __init__(self, price, product=None):
+        super().__init__(product)
+        self.price = price
+        pass
+
+    def check(self, event):
+        below = event.price <= self.price
+        # Only on crossing the threshold, not on every change below it
+        return below and (event.previous is None or event.previous > self.price)
+
+
+class PriceDrop(AlertRule):
+    name = "price_drop"
+    kinds = ("down",)
+
+    def __init__(self, change=0.1, product=None):
+        super().__init__(product)
+        self.change = change
+        pass
+
+    def check(self, event):
+        return -event.change >= self.change
+
+
+class PriceTracker(object):
+
+    # Compares each scan with the last known price of its offers, keyed by
+    # (product, shop, info), and emits only the changes. The state of an
+    # offer is its last price (None once removed), its lowest price and the
+    # time it was last seen; it is kept in SQLite when a path is given.
+    schema = """
+    CREATE TABLE IF NOT EXISTS offers (
+        product TEXT NOT NULL,
+        shop TEXT NOT NULL,
+        info TEXT NOT NULL,
+        price REAL,
+        low REAL,
+        seen REAL,
+        PRIMARY KEY (product, shop, info)
+    );
+    """
+
+    def __init__(self, rules=[], min_change=0.0, path=None):
+        # Price changes below min_change (relative) are not emitted
+        self.rules = list(rules)
+        self.min_change = min_change
+        self.state = {}
+        # Offers currently listed by each (product, shop)
+        self.listed = {}
+        self.conn = None
+        self._lock = threading.Lock()
+        if path is not None:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(self.schema)
+            for product, shop, info, price, low, seen in self.conn.execute(
+                "SELECT * FROM offers"
+            ):
+                self.state[(product, shop, info)] = [price, low, seen]
+                if price is not None:
+                    self.listed.setdefault((product, shop), set()).add(info)
+        pass
+
+    def __len__(self):
+        return len(self.state)
+
+    def update(self, offers, product=None, shop=None, timestamp=None):
+        # offers is the complete result of a scan of product on shop. When
+        # shop is None the shops of the offers are the ones scanned, so a
+        # shop with no offer left is only noticed when given explicitly.
+        timestamp = time.time() if timestamp is None else to_epoch(timestamp)
+        groups = {}
+        if shop is not None:
+            groups[(product, shop)] = {}
+        for o in offers:
+            key = (o.get("product", product), o.get("shop", shop))
+            prices = groups.setdefault(key, {})
+            price = o["price"]
+            if price is None or price != price:
+                continue
+            # Same title listed twice, the cheapest one is kept
+            if o["info"] not in prices or price < prices[o["info"]]:
+                prices[o["info"]] = price
+
+        events = []
+        changed = []
+        with self._lock:
+            for (p, s), prices in groups.items():
+                listed = self.listed.get((p, s), set())
+                for info in listed - set(prices):
+                    state = self.state[(p, s, info)]
+                    events += [
+                        PriceEvent(
+                            "removed", p, s, info, None, state[0], state[1], timestamp
+                        )
+                    ]
+                    state[0] = None
+                    changed += [(p, s, info)]
+                for info, price in prices.items():
+                    event = self.compare(p, s, info, price, timestamp)
+                    if event is not None:
+                        events += [event]
+                        changed += [(p, s, info)]
+                self.listed[(p, s)] = set(prices)
+            self.save(changed)
+
+        for event in events:
+            event.alerts = [
+                r for r in self.rules if r.applies(event) and r.check(event)
+            ]
+        return events
+
+    def compare(self, product, shop, info, price, timestamp):
+        state = self.state.get((product, shop, info))
+        if state is None:
+            self.state[(product, shop, info)] = [price, price, timestamp]
+            return PriceEvent("new", product, shop, info, price, None, None, timestamp)
+
+        last, low, _ = state
+        state[2] = timestamp
+        state[0] = price
+        state[1] = price if low is None else min(low, price)
+        if last is None:
+            # Listed again after being removed
+            return PriceEvent("new", product, shop, info, price, None, low, timestamp)
+        if last == 0 or abs(price - last) / last <= self.min_change:
+            # The last emitted price is kept as the reference
+            state[0] = last
+            return None
+        kind = "up" if price > last else "down"
+        return PriceEvent(kind, product, shop, info, price, last, low, timestamp)
+
+    def save(self, keys):
+        if self.conn is None or len(keys) == 0:
+            return
+        sql = "INSERT OR REPLACE INTO offers VALUES (?, ?, ?, ?, ?, ?)"
+        rows = [k + tuple(self.state[k]) for k in keys]
+        with self.conn:
+            self.conn.executemany(sql, rows)
+        pass
+
+    def feed(self, events):
+        # Price changes of a ScanEvent stream (Scan.iter_events), failed and
+        # timed out shops leave their offers untouched
+        for event in events:
+            if event.status != "done":
+                continue
+            for change in self.update(event.offers, event.product, event.shop):
+                yield change
+
+    def prune(self, before):
+        # Forgets the offers removed and not seen since before
+        before = to_epoch(before)
+        with self._lock:
+            keys = [
+                k
+                for k, (price, _, seen) in self.state.items()
+                if price is None and seen < before
+            ]
+            for k in keys:
+                del self.state[k]
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.executemany(
+                        "DELETE FROM offers WHERE product = ? AND shop = ? AND info = ?",
+                        keys,
+                    )
+        return len(keys)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+        pass
+
+    pass
+
+
+def load_watchlist(path):
+    # Products of a watchlist file as Scan query dicts. JSON files hold a
+    # list, JSON lines files one item per line, the items are product names
+    # or dicts with the get_product arguments ("product", "exclude",
+    # "include", "or_include", ...). Other files have a product per line.
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            items = json.load(f)
+        elif path.endswith(".jsonl"):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = [line.strip() for line in f]
+            items = [i for i in items if i and not i.startswith("#")]
+    return [i if isinstance(i, dict) else {"product": i} for i in items]
+
+
+class OfferWriter(object):
+
+    # Appends the offers of each shop to a file as they arrive, every batch
+    # is flushed so a crash keeps the results already written
+    def __init__(self, path):
+        self.path = path
+        self.rows = 0
+        pass
+
+    def write(self, offers, **defaults):
+        df = offers_frame(offers, **defaults)
+        if len(df) > 0:
+            self.write_frame(df)
+            self.rows += len(df)
+        return len(df)
+
+    def write_frame(self, df):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        pass
+
+    pass
+
+
+class CsvWriter(OfferWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.fp = open(path, "a", newline="", encoding="utf-8")
+        # Appending to an existing file does not repeat the header
+        self.header = self.fp.tell() == 0
+        pass
+
+    def write_frame(self, df):
+        df.to_csv(self.fp, header=self.header, index=False)
+        self.header = False
+        self.fp.flush()
+        pass
+
+    def close(self):
+        self.fp.close()
+        pass
+
+    pass
+
+
+class JsonlWriter(OfferWriter):
+    def __init__(self, path):
+        super().__init__(path)
+        self.fp = open(path, "a", encoding="utf-8")
+        pass
+
+    def write_frame(self, df):
+        lines = df.to_json(orient="records", lines=True, force_ascii=False)
+        self.fp.write(lines if lines.endswith("\n") else lines + "\n")
+        self.fp.flush()
+        pass
+
+    def close(self):
+        self.fp.close()
+        pass
+
+    pass
+
+
+class ParquetWriter(OfferWriter):
+
+    # A Parquet file is only readable once its footer is written, so each
+    # batch is a part file of the path directory, read back with
+    # pd.read_parquet(path)
+    def __init__(self, path):
+        super().__init__(path)
+        os.makedirs(path, exist_ok=True)
+        parts = [f for f in os.listdir(path) if f.startswith("part-")]
+        self.part = len(parts)
+        pass
+
+    def write_frame(self, df):
+        name = "part-{:05d}.parquet".format(self.part)
+        # Hidden until complete, the readers skip the dot files
+        tmp = os.path.join(self.path, "." + name)
+        df.to_parquet(tmp, index=False)
+        os.replace(tmp, os.path.join(self.path, name))
+        self.part += 1
+        pass
+
+    pass
+
+
+def open_writer(path):
+    # Writer of the file format given by the extension
+    writers = {".csv": CsvWriter, ".jsonl": JsonlWriter, ".parquet": ParquetWriter}
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in writers:
+        raise ValueError("Unknown output format {!r}".format(ext))
+    return writers[ext](path)
+
+
+class ShopRun(object):
+
+    # Driver of a shop being scanned by Scan.run_shop, abandoned by the scan
+    # when the shop times out. The timeout counts from the start of the
+    # shop, without the time waiting for a pool browser.
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.driver = None
+        self.pool = None
+        self.abandoned = False
+        self.done = False
+        self.dropped = None
+        self.started = None
+        self.waiting = None
+        self.waited = 0.0
+        self.lock = threading.Lock()
+        pass
+
+    def start(self):
+        with self.lock:
+            self.started = time.perf_counter()
+        pass
+
+    def pause(self):
+        with self.lock:
+            self.waiting = time.perf_counter()
+        pass
+
+    def resume(self):
+        with self.lock:
+            self.waited += time.perf_counter() - self.waiting
+            self.waiting = None
+        pass
+
+    def deadline(self, now):
+        # Not before now + the time left while the shop is not started or
+        # is waiting for a browser
+        if self.timeout is None:
+            return None
+        with self.lock:
+            if self.started is None:
+                return now + self.timeout
+            end = now if self.waiting is None else self.waiting
+            used = end - self.started - self.waited
+        return now + self.timeout - used
+
+    pass
+
+
+class ScanEvent(object):
+
+    # Status of a (product, shop) pair streamed by Scan.iter_events
+    def __init__(self, status, shop, product, offers=[], error=None, elapsed=0.0):
+        self.status = status
+        self.shop = shop
+        self.product = product
+        self.offers = offers
+        self.error = error
+        self.elapsed = elapsed
+        pass
+
+    def __repr__(self):
+        return "ScanEvent({}, {!r}, {!r}, {} offers)".format(
+            self.status, self.shop, self.product, len(self.offers)
+        )
+
+    pass
+
+
 class Scan(object):
-    def __init__(self, browser=None):
-        self.browser = get_browser(headless=True) if browser is None else browser
+    def __init__(
+        self,
+        browser=None,
+        pool_size=None,
+        headless=True,
+        http=False,
+        cache=None,
+        pool=None,
+        lean=False,
+        health=None,
+        recycle=None,
+    ):
+        # Without a browser the scan uses a browser pool, pool_size above one
+        # enables the concurrent mode with one worker per shop. A pool
+        # shared by several Scan objects can be given instead. With a
+        # ShopHealth the shops with an open circuit are skipped and with a
+        # RecyclePolicy the pool browsers are restarted by it.
+        self.fetcher = HttpFetcher() if http else None
+        self.cache = cache
+        self.health = health
+        # Metrics of the last scan and of all the scans of this object
+        self.metrics = ScanMetrics()
+        self.metrics_total = ScanMetrics()
+        self.pool = pool
+        self.own_pool = False
+        self.lean = lean
+        self.headless = headless
+        self.recycle = recycle
+        if browser is None and pool is None:
+            size = 1 if pool_size is None else pool_size
+            self.pool = BrowserPool(
+                size=size, headless=headless, warm=1, lean=lean, recycle=recycle
+            )
+            self.own_pool = True
+        # Extra lean pools for the shops whitelisting resources
+        self.pools = {}
+        self._lock = threading.Lock()
+        self._browser_lock = threading.Lock()
+        self.browser = browser
+        self.errors = {}
         self.drivers = [
             SubmarinoDriver,
             AmericanasDriver,
@@ -808,12 +3500,728 @@ class Scan(object):
         ]
         pass
 
-    def scan(self, product, exclude=[], include=[], or_include=False):
+    def scan(
+        self,
+        product,
+        exclude=[],
+        include=[],
+        or_include=False,
+        max_pages=1,
+        limit=None,
+        timeout=None,
+    ):
+        results = {}
+        query = {"product": product, "max_pages": max_pages, "limit": limit}
+        for _, shop, out in self.iter_many(
+            [query], exclude, include, or_include, timeout
+        ):
+            results[shop] = out
+
+        # Merge in the drivers order
         out = []
-        # Iterate over all shops
         for shop in self.drivers:
-            s = shop(self.browser)
-            out += s.get_product(product, exclude, include)
-        return pd.DataFrame.from_dict(out)
+            out += results.get(shop.shop, [])
+        df = OfferBatch.from_offers(out).to_frame()
+        return df
+
+    def scan_many(
+        self, products, exclude=[], include=[], or_include=False, timeout=None
+    ):
+        # Long format DataFrame with a product column, each shop results are
+        # converted to columns as they arrive
+        batches = []
+        for product, _, offers in self.iter_many(
+            products, exclude, include, or_include, timeout
+        ):
+            batches += [OfferBatch.from_offers(offers, product=product)]
+        df = OfferBatch.concat(batches).to_frame()
+        return df
+
+    def iter_scan(
+        self,
+        product,
+        exclude=[],
+        include=[],
+        or_include=False,
+        max_pages=1,
+        limit=None,
+        timeout=None,
+    ):
+        # Streams the ScanEvent of each shop as soon as it is ready
+        query = {"product": product, "max_pages": max_pages, "limit": limit}
+        return self.iter_events([query], exclude, include, or_include, timeout)
+
+    def iter_many(
+        self, products, exclude=[], include=[], or_include=False, timeout=None
+    ):
+        # Yields (product, shop, offers) as they are ready
+        for event in self.iter_events(products, exclude, include, or_include, timeout):
+            if event.status in ("done", "failed"):
+                yield event.product, event.shop, event.offers
+
+    def iter_events(
+        self, products, exclude=[], include=[], or_include=False, timeout=None
+    ):
+        # Yields ScanEvent objects: "started", "done" or "failed" (an error
+        # or a search that could not read the shop, see ShopDriver.failed)
+        # for each (product, shop), "skipped" when its circuit is open and
+        # "timeout" for the ones not finished when the timeout expires. The
+        # timeout is counted per shop from its start, without the time
+        # waiting for a pool browser. A wedged shop is left behind and the
+        # next ones still run. products items are names or dicts with the
+        # get_product arguments to override the filters per product.
+        queries = []
+        for p in products:
+            q = {"exclude": exclude, "include": include, "or_include": or_include}
+            q.update(p if isinstance(p, dict) else {"product": p})
+            queries += [q]
+        self.errors = {}
+        self.metrics = ScanMetrics()
+
+        # All the shops at once in the concurrent mode, otherwise in order
+        if self.pool is not None and self.pool.size > 1:
+            limit = len(self.drivers)
+        else:
+            limit = 1
+
+        events = queue.Queue()
+
+        def worker(shop, run):
+            try:
+                for event in self.run_shop(shop, queries, run):
+                    events.put(event)
+            except Exception as e:
+                print("Fail to scan {}!".format(shop.shop))
+                print(e)
+            finally:
+                events.put(shop)
+
+        # A thread per shop, the abandoned ones do not hold the next shops
+        executor = ThreadPoolExecutor(max_workers=max(len(self.drivers), 1))
+        waiting = list(self.drivers)
+        running = {}
+        finished = set()
+        try:
+            while len(waiting) > 0 or len(running) > 0:
+                while len(waiting) > 0 and len(running) < limit:
+                    shop = waiting.pop(0)
+                    run = ShopRun(timeout)
+                    running[shop] = run
+                    executor.submit(worker, shop, run)
+
+                now = time.perf_counter()
+                deadlines = [r.deadline(now) for r in running.values()]
+                deadlines = [d for d in deadlines if d is not None]
+                wait = None
+                if len(deadlines) > 0:
+                    wait = max(0.0, min(deadlines) - now)
+                try:
+                    item = events.get(timeout=wait)
+                except queue.Empty:
+                    now = time.perf_counter()
+                    for shop, run in list(running.items()):
+                        deadline = run.deadline(now)
+                        if deadline is None or deadline > now:
+                            continue
+                        del running[shop]
+                        self.abandon(run)
+                        for q in queries:
+                            if (q["product"], shop.shop) in finished:
+                                continue
+                            error = TimeoutError("Scan timed out")
+                            self.errors[(q["product"], shop.shop)] = error
+                            yield ScanEvent(
+                                "timeout", shop.shop, q["product"], error=error
+                            )
+                    continue
+                if isinstance(item, ScanEvent):
+                    # Late events of an abandoned shop were reported as timeout
+                    if not any(s.shop == item.shop for s in running):
+                        continue
+                    if item.status != "started":
+                        finished.add((item.product, item.shop))
+                    yield item
+                else:
+                    running.pop(item, None)
+        finally:
+            executor.shutdown(wait=False)
+            self.metrics_total.update(self.metrics)
+
+    def abandon(self, run):
+        # The timed out shop browser is not used by the next shops: a pool
+        # browser is dropped, which also fails the wedged commands, and the
+        # scan browser stays locked until the wedged worker ends.
+        with run.lock:
+            if run.done:
+                return
+            run.abandoned = True
+            if run.pool is None or run.driver is None:
+                return
+            run.dropped = run.driver.browser
+        if run.dropped is not None:
+            run.pool.discard(run.dropped)
+        pass
+
+    def run_shop(self, shop, queries, run=None):
+        # Runs all the queries on a single warm driver of the shop. Queries
+        # served by the cache or the HTTP backend do not need a browser, so
+        # it is only checked out from the pool on the first Selenium fallback.
+        # The scan browser is used by a single shop at a time.
+        errors = self.errors
+        run = ShopRun() if run is None else run
+        run.start()
+        pool = self.pool_for(shop)
+        run.pool = pool
+        if pool is not None:
+
+            def checkout():
+                # Waiting for a browser used by another shop is not timed
+                run.pause()
+                try:
+                    return pool.checkout()
+                finally:
+                    run.resume()
+
+            release = pool.checkin
+        else:
+
+            def checkout():
+                self._browser_lock.acquire()
+                return self.browser
+
+            release = lambda browser: self._browser_lock.release()
+
+        def browser_factory():
+            browser = checkout()
+            if run.abandoned:
+                release(browser)
+                raise TimeoutError("Scan timed out")
+            return browser
+
+        driver = shop(
+            None,
+            self.fetcher,
+            reuse_page=True,
+            cache=self.cache,
+            browser_factory=browser_factory,
+            metrics=self.metrics,
+            health=self.health,
+        )
+        run.driver = driver
+
+        def record(product, error):
+            # The abandoned shops were already reported as timed out
+            if not run.abandoned:
+                errors[(product, shop.shop)] = error
+
+        try:
+            for q in queries:
+                if run.abandoned:
+                    break
+                product = q["product"]
+                if self.health is not None and not self.health.allow(shop.shop):
+                    error = CircuitOpen("{} is failing".format(shop.shop))
+                    record(product, error)
+                    yield ScanEvent("skipped", shop.shop, product, error=error)
+                    continue
+                yield ScanEvent("started", shop.shop, product)
+                start = time.perf_counter()
+                try:
+                    out = driver.get_product(**q)
+                except Exception as e:
+                    # Keep the other shops and products results
+                    print("Fail to scan {} on {}!".format(product, shop.shop))
+                    print(e)
+                    record(product, e)
+                    elapsed = time.perf_counter() - start
+                    yield ScanEvent("failed", shop.shop, product, [], e, elapsed)
+                    continue
+                elapsed = time.perf_counter() - start
+                if driver.failed:
+                    # The shop was not read, not a shop without offers
+                    error = SearchFailed("Fail to search {}".format(product))
+                    if driver.error is not None:
+                        error.__cause__ = driver.error
+                    record(product, error)
+                    yield ScanEvent("failed", shop.shop, product, [], error, elapsed)
+                    continue
+                yield ScanEvent("done", shop.shop, product, out, None, elapsed)
+        finally:
+            with run.lock:
+                run.done = True
+                browser = driver.browser
+                if browser is run.dropped:
+                    browser = None
+            if browser is None:
+                pass
+            elif run.abandoned and pool is not None:
+                # Checked out after the shop was abandoned
+                pool.discard(browser)
+            else:
+                release(browser)
+
+    def pool_for(self, shop):
+        # Shops whitelisting lean resources need browsers with their profile
+        if not self.own_pool or not self.lean or len(shop.lean_allow) == 0:
+            return self.pool
+        key = tuple(sorted(shop.lean_allow))
+        with self._lock:
+            if key not in self.pools:
+                self.pools[key] = BrowserPool(
+                    size=self.pool.size,
+                    headless=self.headless,
+                    lean=True,
+                    allow=key,
+                    recycle=self.recycle,
+                )
+        return self.pools[key]
+
+    def browser_stats(self):
+        # Pool stats of the scan browsers by pool, see BrowserPool.stats
+        out = {}
+        if self.pool is not None:
+            out["default"] = self.pool.stats()
+        for key, pool in self.pools.items():
+            out[", ".join(key)] = pool.stats()
+        return out
+
+    def close(self):
+        if self.own_pool:
+            self.pool.close()
+        for pool in self.pools.values():
+            pool.close()
+        if self.fetcher is not None:
+            self.fetcher.close()
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+        pass
+
+    pass
+
+
+# Entry point group of the third-party drivers, e.g. in a pyproject.toml:
+# [project.entry-points."prices_monitor.drivers"]
+# "My Shop" = "my_package.drivers:MyShopDriver"
+DRIVERS_GROUP = "prices_monitor.drivers"
+
+
+def shop_drivers(base=None):
+    # Drivers by shop name, subclasses included
+    base = ShopDriver if base is None else base
+    out = {}
+    for cls in base.__subclasses__():
+        out[cls.shop] = cls
+        out.update(shop_drivers(cls))
+    return out
+
+
+def driver_entry_points():
+    # Entry points of the drivers group, the drivers are not imported
+    from importlib import metadata
+
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=DRIVERS_GROUP))
+    return list(eps.get(DRIVERS_GROUP, []))
+
+
+def driver_names():
+    # Shop names of the defined and the registered drivers
+    names = set(shop_drivers())
+    return sorted(names | set([ep.name for ep in driver_entry_points()]))
+
+
+def get_driver(name):
+    # Driver class by shop or class name, third-party drivers are imported
+    # from their entry point on the first request
+    drivers = shop_drivers()
+    if name in drivers:
+        return drivers[name]
+    for cls in drivers.values():
+        if cls.__name__ == name:
+            return cls
+    for ep in driver_entry_points():
+        if ep.name == name:
+            return ep.load()
+    raise KeyError("Unknown shop driver {!r}".format(name))
+
+
+def job_key(product, shop, filters={}):
+    # Jobs are unique by product, shop and get_product arguments
+    return json.dumps([product, shop, filters], sort_keys=True)
+
+
+class JobQueue(object):
+
+    # Interface of the job queue backends. A job runs get_product of a
+    # (product, shop, filters) key, workers lease jobs of their shards for a
+    # while and must complete them with the lease token. Expired leases are
+    # leased again up to max_attempts, so the jobs of a crashed worker are
+    # resumed and a late complete of the old lease is refused.
+    def put(self, product, shops, filters={}):
+        raise NotImplementedError
+
+    def lease(self, worker, n=1, duration=600, shards=None):
+        raise NotImplementedError
+
+    def extend(self, job, duration=600):
+        raise NotImplementedError
+
+    def complete(self, job, offers):
+        raise NotImplementedError
+
+    def fail(self, job, error):
+        raise NotImplementedError
+
+    def results(self, since=None):
+        raise NotImplementedError
+
+    def stats(self):
+        raise NotImplementedError
+
+    pass
+
 
+class Job(object):
+    def __init__(self, id, product, shop, filters, attempts, token):
+        self.id = id
+        self.product = product
+        self.shop = shop
+        self.filters = filters
+        self.attempts = attempts
+        self.token = token
+        pass
+
+    def __repr__(self):
+        return "Job({}, {!r}, {!r})".format(self.id, self.product, self.shop)
+
+    pass
+
+
+class SqliteJobQueue(JobQueue):
+
+    # Default backend, a SQLite file shared by the worker processes of a
+    # node. status is pending, leased, done or failed.
+    schema = """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        key TEXT NOT NULL UNIQUE,
+        product TEXT NOT NULL,
+        shop TEXT NOT NULL,
+        filters TEXT NOT NULL,
+        shard INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        available REAL NOT NULL,
+        worker TEXT,
+        token TEXT,
+        lease_until REAL,
+        error TEXT,
+        result TEXT,
+        finished REAL
+    );
+    CREATE INDEX IF NOT EXISTS jobs_status_shard_available
+        ON jobs (status, shard, available);
+    CREATE INDEX IF NOT EXISTS jobs_finished ON jobs (finished);
+    """
+
+    def __init__(self, path="jobs.db", shards=1, max_attempts=3, backoff=30):
+        self.path = path
+        self.shards = shards
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.conn = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.schema)
+        self._lock = threading.Lock()
+        pass
+
+    @contextmanager
+    def transaction(self):
+        # BEGIN IMMEDIATE takes the write lock, no two workers lease the
+        # same job
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def shard(self, key):
+        return zlib.crc32(key.encode("utf-8")) % self.shards
+
+    def put(self, product, shops, filters={}):
+        # Queues a run of product on each shop. A key already pending or
+        # leased is not queued twice, a finished one is run again.
+        now = time.time()
+        rows = []
+        for shop in shops:
+            shop = getattr(shop, "shop", shop)
+            key = job_key(product, shop, filters)
+            rows += [(key, product, shop, json.dumps(filters), self.shard(key), now)]
+        sql = """
+        INSERT INTO jobs (key, product, shop, filters, shard, status, available)
+        VALUES (?, ?, ?, ?, ?, 'pending', ?)
+        ON CONFLICT (key) DO UPDATE SET
+            status = 'pending', attempts = 0, available = excluded.available,
+            worker = NULL, token = NULL, lease_until = NULL, error = NULL
+        WHERE status IN ('done', 'failed')
+        """
+        with self.transaction() as conn:
+            conn.executemany(sql, rows)
+        return len(rows)
+
+    def lease(self, worker, n=1, duration=600, shards=None):
+        # Pending jobs and jobs of expired leases, oldest first. An expired
+        # lease of the last attempt fails the job, e.g. a job crashing its
+        # workers.
+        now = time.time()
+        expired = """
+        UPDATE jobs SET status = 'failed', error = 'Lease expired', token = NULL,
+            lease_until = NULL, finished = ?
+        WHERE status = 'leased' AND lease_until < ? AND attempts >= ?
+        """
+        sql = """
+        SELECT id, product, shop, filters, attempts FROM jobs
+        WHERE ((status = 'pending' AND available <= ?)
+            OR (status = 'leased' AND lease_until < ?))
+        """
+        params = [now, now]
+        if shards is not None:
+            shards = list(shards)
+            sql += " AND shard IN ({})".format(", ".join("?" * len(shards)))
+            params += shards
+        sql += " ORDER BY available LIMIT ?"
+        params += [n]
+
+        jobs = []
+        with self.transaction() as conn:
+            conn.execute(expired, (now, now, self.max_attempts))
+            for id, product, shop, filters, attempts in conn.execute(sql, params):
+                token = uuid.uuid4().hex
+                jobs += [
+                    Job(id, product, shop, json.loads(filters), attempts + 1, token)
+                ]
+            conn.executemany(
+                """
+                UPDATE jobs SET status = 'leased', attempts = ?, worker = ?,
+                    token = ?, lease_until = ?
+                WHERE id = ?
+                """,
+                [(j.attempts, worker, j.token, now + duration, j.id) for j in jobs],
+            )
+        return jobs
+
+    def extend(self, job, duration=600):
+        sql = "UPDATE jobs SET lease_until = ? WHERE id = ? AND token = ?"
+        with self.transaction() as conn:
+            cur = conn.execute(sql, (time.time() + duration, job.id, job.token))
+        return cur.rowcount == 1
+
+    def complete(self, job, offers):
+        # False when the lease was lost, the offers of the run are dropped
+        sql = """
+        UPDATE jobs SET status = 'done', result = ?, error = NULL,
+            token = NULL, lease_until = NULL, finished = ?
+        WHERE id = ? AND token = ?
+        """
+        result = json.dumps([dict(o) for o in offers], default=str)
+        with self.transaction() as conn:
+            cur = conn.execute(sql, (result, time.time(), job.id, job.token))
+        return cur.rowcount == 1
+
+    def fail(self, job, error):
+        # Retried with an exponential backoff up to max_attempts
+        now = time.time()
+        if job.attempts >= self.max_attempts:
+            status, available = "failed", now
+        else:
+            status = "pending"
+            available = now + self.backoff * 2 ** (job.attempts - 1)
+        sql = """
+        UPDATE jobs SET status = ?, available = ?, error = ?, token = NULL,
+            lease_until = NULL, finished = ?
+        WHERE id = ? AND token = ?
+        """
+        finished = now if status == "failed" else None
+        params = (status, available, repr(error), finished, job.id, job.token)
+        with self.transaction() as conn:
+            cur = conn.execute(sql, params)
+        return cur.rowcount == 1
+
+    def results(self, since=None):
+        # Offers of the jobs done after since, long format like scan_many
+        sql = "SELECT product, shop, result, finished FROM jobs WHERE status = 'done'"
+        params = []
+        if since is not None:
+            sql += " AND finished >= ?"
+            params += [to_epoch(since)]
+        batches = []
+        for product, shop, result, finished in self.conn.execute(sql, params):
+            offers = json.loads(result)
+            batches += [
+                OfferBatch.from_offers(offers, product=product, timestamp=finished)
+            ]
+        return OfferBatch.concat(batches).to_frame()
+
+    def stats(self):
+        sql = "SELECT status, COUNT(*) FROM jobs GROUP BY status"
+        return dict(self.conn.execute(sql).fetchall())
+
+    def close(self):
+        self.conn.close()
+        pass
+
+    pass
+
+
+class JobWorker(object):
+
+    # Leases the jobs of its shards and runs them on its own browser. The
+    # lease is extended before each job of a batch, so it only has to be
+    # longer than a single get_product.
+    def __init__(
+        self,
+        queue,
+        worker=None,
+        shards=None,
+        batch=1,
+        duration=600,
+        browser=None,
+        headless=True,
+        lean=False,
+        fetcher=None,
+        health=None,
+        recycle=None,
+    ):
+        self.queue = queue
+        self.health = health
+        self.recycle = recycle
+        self.worker = (
+            "{}-{}".format(os.getpid(), id(self)) if worker is None else worker
+        )
+        self.shards = shards
+        self.batch = batch
+        self.duration = duration
+        self.own_browser = browser is None
+        self.headless = headless
+        self.lean = lean
+        self.browser = browser
+        self.fetcher = fetcher
+        self.metrics = ScanMetrics()
+        self.done = 0
+        self.failed = 0
+        pass
+
+    def get_browser(self):
+        if self.browser is None:
+            factory = partial(get_browser, self.headless, self.lean)
+            if self.recycle is None:
+                self.browser = factory()
+            else:
+                self.browser = RecyclingBrowser(factory, self.recycle)
+        return self.browser
+
+    def run_job(self, job):
+        shop = get_driver(job.shop)
+        driver = shop(
+            None,
+            self.fetcher,
+            reuse_page=True,
+            browser_factory=self.get_browser,
+            metrics=self.metrics,
+            health=self.health,
+        )
+        # Retried later with the queue backoff
+        if self.health is not None and not self.health.allow(job.shop):
+            raise CircuitOpen("{} is failing".format(job.shop))
+        out = driver.get_product(job.product, **job.filters)
+        if driver.failed:
+            # The shop was not read, not a shop without offers
+            error = SearchFailed("Fail to search {}".format(job.product))
+            raise error from driver.error
+        return out
+
+    def run(self, idle=None, poll=1.0):
+        # Runs until the queue has no job for idle seconds, forever when
+        # idle is None
+        last = time.perf_counter()
+        try:
+            while True:
+                jobs = self.queue.lease(
+                    self.worker, self.batch, self.duration, self.shards
+                )
+                if len(jobs) == 0:
+                    if idle is not None and time.perf_counter() - last >= idle:
+                        break
+                    time.sleep(poll)
+                    continue
+                for job in jobs:
+                    if not self.queue.extend(job, self.duration):
+                        continue
+                    try:
+                        out = self.run_job(job)
+                    except Exception as e:
+                        print("Fail to run {}!".format(job))
+                        print(e)
+                        self.queue.fail(job, e)
+                        self.failed += 1
+                        # A broken browser is replaced on the next job, a
+                        # skipped shop did not use it
+                        if not isinstance(e, CircuitOpen):
+                            self.restart()
+                        continue
+                    if self.queue.complete(job, out):
+                        self.done += 1
+                last = time.perf_counter()
+        finally:
+            self.close()
+
+    def restart(self):
+        if self.own_browser and self.browser is not None:
+            try:
+                self.browser.quit()
+            except Exception:
+                pass
+            self.browser = None
+        pass
+
+    def close(self):
+        self.restart()
+        if self.fetcher is not None:
+            self.fetcher.close()
+        pass
+
+    pass
+
+
+def _run_worker(factory, worker, shards, kwargs, idle):
+    # Worker process entry, the queue is opened in the process
+    queue = factory()
+    JobWorker(queue, worker, shards, **kwargs).run(idle)
     pass
+
+
+def start_workers(factory, n, shards=None, idle=None, **kwargs):
+    # Starts n worker processes of a node. factory opens the queue backend
+    # in each process, e.g. functools.partial(SqliteJobQueue, "jobs.db").
+    # Nodes split the work by leasing different shards.
+    processes = []
+    for i in range(n):
+        worker = "{}-{}".format(os.uname().nodename, i)
+        p = multiprocessing.Process(
+            target=_run_worker, args=(factory, worker, shards, kwargs, idle)
+        )
+        p.start()
+        processes += [p]
+    return processes
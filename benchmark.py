@@ -0,0 +1,502 @@
+import argparse
+import functools
+import hashlib
+import http.server
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+import pandas as pd
+import requests
+
+from DriverLib import (
+    AmazonDriver,
+    AmericanasDriver,
+    CasasBahiaDriver,
+    GoogleShopDriver,
+    KabumDriver,
+    MagaLuDriver,
+    Offer,
+    OfferBatch,
+    PontoFrioDriver,
+    ShoptimeDriver,
+    SubmarinoDriver,
+    count_commands,
+    filter_products,
+    get_browser,
+)
+
+DRIVERS = [
+    GoogleShopDriver,
+    AmazonDriver,
+    SubmarinoDriver,
+    AmericanasDriver,
+    ShoptimeDriver,
+    KabumDriver,
+    MagaLuDriver,
+    PontoFrioDriver,
+    CasasBahiaDriver,
+]
+
+# Static copy of the rendered page: scripts and frames are removed so the
+# replay does not re-render or reach the shop, images are not loaded and
+# the stylesheets are inlined (cross-origin ones are returned to be fetched)
+SNAPSHOT_SCRIPT = """
+var rules = [], hrefs = [];
+for (var i = 0; i < document.styleSheets.length; i++) {
+    var sheet = document.styleSheets[i];
+    try {
+        for (var j = 0; j < sheet.cssRules.length; j++) rules.push(sheet.cssRules[j].cssText);
+    } catch (e) {
+        if (sheet.href) hrefs.push(sheet.href);
+    }
+}
+var doc = document.documentElement.cloneNode(true);
+var drop = doc.querySelectorAll('script, iframe, noscript, style, link[rel~="stylesheet"], link[rel~="preload"]');
+for (i = 0; i < drop.length; i++) drop[i].remove();
+var images = doc.querySelectorAll('img, source');
+for (i = 0; i < images.length; i++) {
+    images[i].removeAttribute('src');
+    images[i].removeAttribute('srcset');
+}
+return ['<!DOCTYPE html>' + doc.outerHTML, rules.join('\\n'), hrefs];
+"""
+
+# Dependencies the library must not load on import
+HEAVY_MODULES = [
+    "babel",
+    "bs4",
+    "fuzzywuzzy",
+    "numpy",
+    "pandas",
+    "rapidfuzz",
+    "requests",
+    "selenium",
+    "unidecode",
+]
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import DriverLib
+print(time.perf_counter() - start)
+print(" ".join(m for m in {} if m in sys.modules))
+""".format(HEAVY_MODULES)
+
+
+class PageArchive(object):
+
+    # Directory with the recorded pages and a manifest mapping each
+    # (shop, product) to its results page and the other visited pages
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest_path = os.path.join(path, "manifest.json")
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        pass
+
+    def entry(self, shop, product):
+        return self.manifest.get(shop, {}).get(product)
+
+    def products(self, shop):
+        return list(self.manifest.get(shop, {}).keys())
+
+    def save_page(self, html):
+        name = hashlib.sha1(html.encode()).hexdigest()[:16] + ".html"
+        with open(os.path.join(self.path, name), "w", encoding="utf-8") as f:
+            f.write(html)
+        return name
+
+    def add(self, shop, product, results, pages):
+        self.manifest.setdefault(shop, {})[product] = {
+            "results": results,
+            "pages": pages,
+        }
+        with open(self.manifest_path, "w") as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        pass
+
+    pass
+
+
+class Recorder(object):
+    def __init__(self, browser, archive):
+        self.browser = browser
+        self.archive = archive
+        self.session = requests.Session()
+        self.stylesheets = {}
+        pass
+
+    def stylesheet(self, href):
+        if href not in self.stylesheets:
+            try:
+                self.stylesheets[href] = self.session.get(href, timeout=10).text
+            except requests.RequestException:
+                self.stylesheets[href] = ""
+        return self.stylesheets[href]
+
+    def snapshot(self):
+        html, rules, hrefs = self.browser.execute_script(SNAPSHOT_SCRIPT)
+        css = "\n".join([self.stylesheet(h) for h in hrefs] + [rules])
+        html = html.replace("</head>", "<style>{}</style></head>".format(css), 1)
+        return self.archive.save_page(html)
+
+    def record(self, driver_cls, product):
+        browser = self.browser
+        driver = driver_cls(browser)
+        driver.search(product)
+        results_window = browser.current_window_handle
+
+        # Pages are saved when the driver leaves them, it is the moment
+        # they were read
+        pages = {}
+
+        def snapshot_current():
+            url = browser.current_url
+            if url.startswith("http"):
+                pages[url] = self.snapshot()
+
+        get, close = browser.get, browser.close
+
+        def recording_get(url):
+            snapshot_current()
+            get(url)
+
+        def recording_close():
+            snapshot_current()
+            close()
+
+        browser.get, browser.close = recording_get, recording_close
+        try:
+            data, success = driver.scan_search()
+        finally:
+            del browser.get, browser.close
+
+        browser.switch_to.window(results_window)
+        self.archive.add(driver_cls.shop, product, self.snapshot(), pages)
+        return data, success
+
+    pass
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    pass
+
+
+class ReplayServer(object):
+
+    # Serves the archive from a local HTTP server
+    def __init__(self, archive):
+        handler = functools.partial(QuietHandler, directory=archive.path)
+        self.httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        pass
+
+    def url(self, name):
+        return "http://127.0.0.1:{}/{}".format(self.httpd.server_port, name)
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        pass
+
+    pass
+
+
+def replay(driver_cls, browser, product, archive, server, js_extract=True):
+    # Runs scan_search on the recorded results page, the pages the driver
+    # opens are served from the archive and unknown ones are blank
+    entry = archive.entry(driver_cls.shop, product)
+    driver = driver_cls(browser)
+    driver.js_extract = js_extract
+
+    get = browser.get
+
+    def replay_get(url):
+        name = entry["pages"].get(url)
+        get("about:blank" if name is None else server.url(name))
+
+    browser.get = replay_get
+    try:
+        get(server.url(entry["results"]))
+        data, success = driver.scan_search()
+    finally:
+        del browser.get
+
+    return data if success else []
+
+
+def benchmark(browser, archive, drivers=DRIVERS, repeat=3):
+    server = ReplayServer(archive)
+    counts = count_commands(browser)
+    out = []
+    try:
+        for driver_cls in drivers:
+            for product in archive.products(driver_cls.shop):
+                walls = []
+                for _ in range(repeat):
+                    calls = sum(counts.values())
+                    start = time.perf_counter()
+                    data = replay(driver_cls, browser, product, archive, server)
+                    walls += [time.perf_counter() - start]
+                    calls = sum(counts.values()) - calls
+                wall = sorted(walls)[len(walls) // 2]
+                # The single call extraction must read what WebElement.text
+                # shows, e.g. no hidden copy of the prices
+                text = replay(driver_cls, browser, product, archive, server, False)
+                same = sorted((o["info"], o["price"]) for o in data) == sorted(
+                    (o["info"], o["price"]) for o in text
+                )
+                out += [
+                    {
+                        "shop": driver_cls.shop,
+                        "product": product,
+                        "wall": wall,
+                        "calls": calls,
+                        "offers": len(data),
+                        "kept": len(filter_products(product, data)),
+                        "offers_per_s": len(data) / wall if wall > 0 else 0.0,
+                        "same_as_text": same,
+                    }
+                ]
+    finally:
+        server.close()
+    return pd.DataFrame(out)
+
+
+def compare(results, baseline, tolerance=0.2):
+    # Rows slower than the baseline by more than tolerance, with more
+    # WebDriver calls or fewer offers
+    base = pd.DataFrame(baseline)
+    if len(base) == 0 or len(results) == 0:
+        return results.iloc[0:0]
+    df = results.merge(base, on=["shop", "product"], suffixes=("", "_base"))
+    slower = df["wall"] > df["wall_base"] * (1 + tolerance)
+    chatty = df["calls"] > df["calls_base"]
+    lost = df["offers"] < df["offers_base"]
+    return df[slower | chatty | lost]
+
+
+def import_times(repeat=5):
+    # Import time of the library and wall time of the CLI --help, each in
+    # a fresh interpreter, the median of repeat runs
+    here = os.path.dirname(os.path.abspath(__file__))
+    imports, cli, heavy = [], [], set()
+    for _ in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", IMPORT_SCRIPT],
+            cwd=here,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.splitlines()
+        imports += [float(out[0])]
+        heavy |= set(out[1].split()) if len(out) > 1 else set()
+
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "price_monitor.py", "--help"],
+            cwd=here,
+            capture_output=True,
+            check=True,
+        )
+        cli += [time.perf_counter() - start]
+    return {
+        "import": sorted(imports)[len(imports) // 2],
+        "cli_help": sorted(cli)[len(cli) // 2],
+        "heavy": sorted(heavy),
+    }
+
+
+def measure(build, convert):
+    # Peak memory of the offers plus their DataFrame and conversion time
+    tracemalloc.start()
+    offers = build()
+    start = time.perf_counter()
+    df = convert(offers)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"rows": len(df), "convert": elapsed, "peak_mb": peak / 2**20}
+
+
+def offers_times(n=200000):
+    # Offers as dicts and DataFrame.from_dict against Offer records and an
+    # OfferBatch, with the same titles and shops
+    shops = ["Amazon", "Kabum", "Submarino", "Americanas"]
+    titles = ["Monitor LG {} 23.8 Full HD".format(i % 5000) for i in range(n)]
+
+    def dicts():
+        return [
+            {"info": t, "price": 1000.0 + i, "shop": shops[i % 4]}
+            for i, t in enumerate(titles)
+        ]
+
+    def offers():
+        now = time.time()
+        return [
+            Offer(t, 1000.0 + i, shops[i % 4], "monitor", "BRL", now)
+            for i, t in enumerate(titles)
+        ]
+
+    def with_product(out):
+        return pd.DataFrame.from_dict([dict(o, product="monitor") for o in out])
+
+    def batch(out):
+        return OfferBatch.from_offers(out).to_frame()
+
+    return pd.DataFrame(
+        [
+            dict(path="dict", **measure(dicts, with_product)),
+            dict(path="offer", **measure(offers, batch)),
+        ]
+    )
+
+
+def main_import(arguments):
+    results = import_times(arguments.repeat)
+    print("import DriverLib: {:.3f} s".format(results["import"]))
+    print("price_monitor.py --help: {:.3f} s".format(results["cli_help"]))
+
+    failed = False
+    if len(results["heavy"]) > 0:
+        print("Heavy modules loaded on import: {}".format(", ".join(results["heavy"])))
+        failed = True
+
+    path = arguments.import_baseline
+    if arguments.update or not os.path.exists(path):
+        with open(path, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to {}".format(path))
+        return 1 if failed else 0
+
+    with open(path) as f:
+        baseline = json.load(f)
+    for k in ["import", "cli_help"]:
+        if results[k] > baseline[k] * (1 + arguments.tolerance):
+            print("Slower than {}: {} {:.3f} s".format(path, k, baseline[k]))
+            failed = True
+    return 1 if failed else 0
+
+
+def main(arguments):
+    if arguments.command == "import":
+        return main_import(arguments)
+    if arguments.command == "offers":
+        print(offers_times().to_string(index=False))
+        return 0
+
+    archive = PageArchive(arguments.archive)
+    drivers = DRIVERS
+    if arguments.shops:
+        drivers = [d for d in DRIVERS if d.shop in arguments.shops]
+
+    browser = get_browser(headless=True)
+    try:
+        if arguments.command == "record":
+            recorder = Recorder(browser, archive)
+            for driver_cls in drivers:
+                for product in arguments.products:
+                    data, success = recorder.record(driver_cls, product)
+                    print(
+                        "{}: {} {} offers".format(driver_cls.shop, product, len(data))
+                    )
+            return 0
+
+        results = benchmark(browser, archive, drivers, arguments.repeat)
+    finally:
+        browser.quit()
+
+    print(results.to_string(index=False))
+
+    differ = results[~results["same_as_text"]] if len(results) > 0 else results
+    if len(differ) > 0:
+        print("Offers not read as WebElement.text shows them:")
+        print(differ.to_string(index=False))
+        return 1
+
+    if arguments.update or not os.path.exists(arguments.baseline):
+        results.to_json(arguments.baseline, orient="records", indent=2)
+        print("Baseline saved to {}".format(arguments.baseline))
+        return 0
+
+    with open(arguments.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, arguments.tolerance)
+    if len(regressions) > 0:
+        print("Regressions against {}:".format(arguments.baseline))
+        print(regressions.to_string(index=False))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    # Initialise parser
+    parser = argparse.ArgumentParser(
+        description="Record shop pages and benchmark the drivers against the local copies"
+    )
+
+    parser.add_argument("command", choices=["record", "run", "import", "offers"])
+    parser.add_argument(
+        "--archive",
+        action="store",
+        dest="archive",
+        default="bench_pages",
+        help="Directory of the recorded pages",
+    )
+    parser.add_argument(
+        "--product",
+        action="append",
+        dest="products",
+        default=[],
+        help="Product to record, can be repeated",
+    )
+    parser.add_argument(
+        "--shop",
+        action="append",
+        dest="shops",
+        default=[],
+        help="Only record/run this shop, can be repeated",
+    )
+    parser.add_argument(
+        "--baseline",
+        action="store",
+        dest="baseline",
+        default="benchmark_baseline.json",
+        help="Stored results to compare with",
+    )
+    parser.add_argument(
+        "--import-baseline",
+        action="store",
+        dest="import_baseline",
+        default="import_baseline.json",
+        help="Stored import times to compare with",
+    )
+    parser.add_argument(
+        "--tolerance",
+        action="store",
+        dest="tolerance",
+        type=float,
+        default=0.2,
+        help="Allowed wall time increase over the baseline",
+    )
+    parser.add_argument("--repeat", action="store", dest="repeat", type=int, default=3)
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        dest="update",
+        help="Replace the baseline with this run",
+    )
+
+    sys.exit(main(parser.parse_args()))
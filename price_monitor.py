@@ -1,18 +1,51 @@
 import argparse
-from DriverLib import Scan
+from DriverLib import PriceStore, Scan, load_watchlist, offers_frame, open_writer
 
 
-def main(product, exclude, include, or_include, filename):
+def main(
+    products,
+    exclude,
+    include,
+    or_include,
+    filename,
+    store="prices.db",
+    output=None,
+    pool_size=None,
+):
 
     # Initiate Scan Driver
-    scan = Scan()
-    # Scan product
-    out = scan.scan(product)
-    # Organise dataframe
-    out.sort_values(by="price", inplace=True)
-    out.reset_index(inplace=True, drop=True)
-    # Save prices
-    out.to_excel("{}.xlsx".format(product))
+    scan = Scan(pool_size=pool_size)
+    history = PriceStore(store)
+    writer = None if output is None else open_writer(output)
+    # The Excel export needs the whole scan, the other outputs are streamed
+    frames = []
+    try:
+        # Each shop results are stored as soon as they arrive
+        for product, shop, offers in scan.iter_many(
+            products, exclude, include, or_include
+        ):
+            df = offers_frame(offers, product=product)
+            history.add(df, product=product)
+            if writer is not None:
+                writer.write(df)
+            if filename is not None:
+                frames += [df]
+            print("{}: {} {} offers".format(shop, product, len(df)))
+    finally:
+        if writer is not None:
+            writer.close()
+        history.close()
+        scan.close()
+
+    # Optional spreadsheet of the current scan
+    if filename is not None:
+        import pandas as pd
+
+        out = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if len(out) > 0:
+            out.sort_values(by=["product", "price"], inplace=True)
+            out.reset_index(inplace=True, drop=True)
+        out.to_excel(filename)
 
 
 if __name__ == "__main__":
@@ -24,57 +57,110 @@ if __name__ == "__main__":
     # Arguments
     parser.add_argument(
         "--product",
+        action="append",
+        dest="products",
+        default=[],
+        required=False,
+        help="Product to search/scan on websites, can be repeated",
+    )
+
+    parser.add_argument(
+        "--watchlist",
         action="store",
-        dest="product",
-        required=True,
-        help="Product to search/scan on websites",
+        dest="watchlist",
+        default=None,
+        required=False,
+        help="File with the products to scan, a product per line or a JSON/JSON lines list of products with their own exclude, include and or_include filters",
     )
 
     parser.add_argument(
         "--exclude",
-        action="store",
+        action="append",
         dest="exclude",
         default=[],
         required=False,
-        help='Used when search for generic product, such as TV, and you want to remove findings with certain terms, for instance, "LCD".',
+        help='Used when search for generic product, such as TV, and you want to remove findings with certain terms, for instance, "LCD". Can be repeated',
     )
 
     parser.add_argument(
         "--include",
-        action="store",
+        action="append",
         dest="include",
         default=[],
         required=False,
-        help='Used when search for generic product, such as TV, and you want to find products that contains certain terms, for instance, "4k".',
+        help='Used when search for generic product, such as TV, and you want to find products that contains certain terms, for instance, "4k". Can be repeated',
     )
 
     parser.add_argument(
         "--or-include",
-        action="store",
+        action="store_true",
         dest="or_include",
         default=False,
         required=False,
-        help="Used when search for generic product, when True accepts having at least one term of include option",
+        help="Used when search for generic product, accepts having at least one term of include option",
+    )
+
+    parser.add_argument(
+        "--output",
+        action="store",
+        dest="output",
+        default=None,
+        required=False,
+        help="CSV, JSON lines or Parquet output (.csv, .jsonl or .parquet), the results of each shop are appended as they arrive",
     )
 
     parser.add_argument(
         "--filename",
         action="store",
-        dest="Filename",
-        default="product",
+        dest="filename",
+        default=None,
+        required=False,
+        help="Excel file to export the current scan",
+    )
+
+    parser.add_argument(
+        "--store",
+        action="store",
+        dest="store",
+        default="prices.db",
         required=False,
-        help="File to store the output",
+        help="SQLite file with the price history",
+    )
+
+    parser.add_argument(
+        "--pool-size",
+        action="store",
+        dest="pool_size",
+        type=int,
+        default=None,
+        required=False,
+        help="Number of browsers, above one the shops are scanned concurrently",
     )
 
     # Parse arguments
     arguments = parser.parse_args()
 
     # Set arguments
-    product = arguments.product
+    products = list(arguments.products)
+    if arguments.watchlist is not None:
+        products += load_watchlist(arguments.watchlist)
+    if len(products) == 0:
+        parser.error("a --product or a --watchlist is required")
+
     exclude = arguments.exclude
     include = arguments.include
     or_include = arguments.or_include
 
     filename = arguments.filename
+    store = arguments.store
 
-    main(product, exclude, include, or_include, filename)
+    main(
+        products,
+        exclude,
+        include,
+        or_include,
+        filename,
+        store,
+        arguments.output,
+        arguments.pool_size,
+    )
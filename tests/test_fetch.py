@@ -0,0 +1,103 @@
+import http.server
+import threading
+
+import pytest
+
+from DriverLib import HttpFetcher, KabumDriver
+
+# Saved Kabum search results, the pages are served by a local server
+ITEM = """
+<div class="sc-fzqNqU">
+  <a class="sc-fzoLsD">{}</a>
+  <div class="sc-fznWqX">{}</div>
+</div>
+"""
+
+
+def page(*offers):
+    items = "".join(ITEM.format(info, price) for info, price in offers)
+    return '<html><body><div id="listagem-produtos">{}</div></body></html>'.format(
+        items
+    )
+
+
+SEARCH = "/cgi-local/site/listagem/listagem.cgi?string=monitor%20lg"
+PAGES = {
+    SEARCH: page(
+        ("Monitor LG 23 IPS", "R$ 1.299,90"),
+        ("Monitor LG 27 4K", "R$ 2.499,00"),
+        ("Suporte para monitor", "R$ 99,90"),
+    ),
+    SEARCH + "&pagina=2": page(("Monitor LG 29 UltraWide", "R$ 1.599,00")),
+    SEARCH + "&pagina=3": page(("Monitor LG 29 UltraWide", "R$ 1.599,00")),
+}
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        Handler.requests += [self.path]
+        html = PAGES.get(self.path)
+        if html is None:
+            self.send_error(404)
+            return
+        body = html.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="module")
+def shop():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    class LocalKabum(KabumDriver):
+        link = "http://127.0.0.1:{}/".format(server.server_port)
+
+    yield LocalKabum
+    server.shutdown()
+    server.server_close()
+
+
+def test_fetch_without_browser(shop):
+    browsers = []
+    driver = shop(None, HttpFetcher(), browser_factory=lambda: browsers.append(1))
+    out = driver.get_product("monitor lg", exclude=["suporte"], max_pages=2)
+
+    assert driver.backend == "fetch"
+    assert not driver.failed
+    assert browsers == []
+    assert [(o["info"], o["price"]) for o in out] == [
+        ("Monitor LG 23 IPS", 1299.9),
+        ("Monitor LG 27 4K", 2499.0),
+        ("Monitor LG 29 UltraWide", 1599.0),
+    ]
+    assert all(o["shop"] == "Kabum" for o in out)
+
+
+def test_paging_stops_on_a_repeated_page(shop):
+    Handler.requests = []
+    driver = shop(None, HttpFetcher())
+    out = driver.get_product("monitor lg", max_pages=5)
+
+    assert len(out) == 3
+    assert Handler.requests == [SEARCH, SEARCH + "&pagina=2", SEARCH + "&pagina=3"]
+
+
+def test_falls_back_to_browser(shop):
+    browsers = []
+    driver = shop(None, HttpFetcher(), browser_factory=lambda: browsers.append(1))
+    out = driver.get_product("monitor samsung")
+
+    # Without a browser the search is a failure, not a product not sold
+    assert out == []
+    assert browsers == [1]
+    assert driver.failed
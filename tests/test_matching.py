@@ -0,0 +1,126 @@
+import random
+
+import pytest
+from fuzzywuzzy import fuzz
+
+import DriverLib
+from DriverLib import filter_products, match_products
+
+WORDS = [
+    "Smart",
+    "TV",
+    "LED",
+    "LCD",
+    "4K",
+    '50"',
+    "50UM751C0SB",
+    "LG",
+    "Samsung",
+    "Monitor",
+    "my232bz",
+    "IPS",
+    "Full",
+    "HD",
+    "Suporte",
+    "Parede",
+    "Controle",
+    "Remoto",
+    "Preto",
+    "Televisão",
+    "Câmera",
+    "-",
+    "+",
+    "/",
+    "(Novo)",
+    "Bivolt",
+    "Wifi",
+    "Suporte_Parede",
+    "smart_tv",
+]
+
+CHARS = "abcdefghijklmnopqrstuvwxyz0123456789_ -"
+
+
+def reference(target, products, exclude=[], include=[], or_include=False):
+    # filter_products before the batch engine
+    fuzz_limit = 90
+
+    exclude_set = set([e.lower() for e in exclude])
+    include_set = set([i.lower() for i in include])
+
+    out = []
+    for p in products:
+        if fuzz.token_set_ratio(target, p["info"]) > fuzz_limit:
+            info_set = set(p["info"].lower().split(" "))
+            if len(info_set - exclude_set) != len(info_set):
+                continue
+            add_factor = (len(include) - 1) * or_include
+            if len(info_set | include_set) > (len(info_set) + add_factor):
+                continue
+            out += [p]
+    return out
+
+
+def random_title(rng):
+    words = rng.sample(WORDS, rng.randint(1, 8))
+    return " ".join(w.upper() if rng.random() < 0.1 else w for w in words)
+
+
+def typo(rng, word):
+    # Missing, extra or wrong characters, as in the titles typed by sellers
+    word = list(word)
+    for _ in range(rng.randint(1, 2)):
+        i = rng.randrange(len(word))
+        op = rng.random()
+        if op < 0.3 and len(word) > 1:
+            del word[i]
+        elif op < 0.6:
+            word.insert(i, rng.choice(CHARS))
+        else:
+            word[i] = rng.choice(CHARS)
+    return "".join(word)
+
+
+def cases(seed=0, n=300):
+    rng = random.Random(seed)
+    for _ in range(n):
+        target = random_title(rng)
+        # Titles close to the target are the interesting ones
+        products = []
+        for _ in range(20):
+            title = target.split(" ")
+            rng.shuffle(title)
+            title = title[: rng.randint(1, len(title))]
+            title = [typo(rng, w) if rng.random() < 0.3 else w for w in title]
+            title += random_title(rng).split(" ")[: rng.randint(0, 3)]
+            products += [{"info": " ".join(title), "price": 1.0}]
+            products += [{"info": random_title(rng), "price": 1.0}]
+        exclude = rng.sample(["lcd", "suporte", "controle"], rng.randint(0, 2))
+        include = rng.sample(["4k", "led", "smart"], rng.randint(0, 2))
+        yield target, products, exclude, include, rng.random() < 0.5
+
+
+@pytest.mark.parametrize("rapidfuzz", [True, False])
+def test_same_decisions_as_fuzzywuzzy(monkeypatch, rapidfuzz):
+    if rapidfuzz and not DriverLib.RAPIDFUZZ:
+        pytest.skip("rapidfuzz is not installed")
+    monkeypatch.setattr(DriverLib, "RAPIDFUZZ", rapidfuzz)
+    accepted = 0
+    for target, products, exclude, include, or_include in cases():
+        expected = reference(target, products, exclude, include, or_include)
+        out = filter_products(target, products, exclude, include, or_include)
+        assert out == expected, target
+        accepted += len(out)
+    # The corpus has both accepted and rejected titles
+    assert accepted > 0
+
+
+def test_match_products_per_target():
+    targets = []
+    products = []
+    for target, items, _, _, _ in cases(seed=1, n=20):
+        targets += [target]
+        products += items
+    out = match_products(targets, products)
+    for target, kept in zip(targets, out):
+        assert kept == reference(target, products)
@@ -0,0 +1,68 @@
+from babel import numbers
+
+from DriverLib import clean_price, parse_prices
+
+# Raw prices as read from the shops pages
+CORPUS = {
+    "pt_BR": [
+        "R$ 1.299,00",
+        "R$ 1.299,90 à vista",
+        "R$ 99,9",
+        "R$ 1.299",
+        "R$\xa02.499,99",
+        "1.234.567,89",
+        "10x de R$ 129,90",
+        "R$ 1.299,00 - R$ 1.499,00",
+        "de R$ 2.000,00 por R$ 1.799,00",
+        "-R$ 15,00",
+        "1,2,3",
+        "",
+        "Indisponível",
+    ],
+    "en_US": ["$1,299.99", "$ 12.5", "1,234,567.00", "$10 - $20", "", "N/A"],
+}
+
+# Amazon splits the cents in another element, joined by a new line
+AMAZON = ["R$ 1.299\n00", "R$ 89\n90", "R$ 1.000.000\n01", "R$ 15", ""]
+
+
+def babel_prices(prices, locale, replace=None):
+    out = []
+    for price in prices:
+        try:
+            price = clean_price(price, replace)
+            out += [float(numbers.parse_decimal(price, locale=locale))]
+        except Exception:
+            out += [None]
+    return out
+
+
+def check(prices, locale, replace=None):
+    values, errors = parse_prices(prices, locale, replace)
+    for price, value, error, expected in zip(
+        prices, values, errors, babel_prices(prices, locale, replace)
+    ):
+        if expected is None:
+            assert error, price
+        else:
+            assert not error, price
+            assert value == expected, price
+
+
+def test_same_prices_as_babel():
+    for locale, prices in CORPUS.items():
+        check(prices, locale)
+
+
+def test_amazon_cents():
+    check(AMAZON, "pt_BR", ["\n", ","])
+    values, errors = parse_prices(AMAZON, "pt_BR", ["\n", ","])
+    assert list(values[:3]) == [1299.0, 89.9, 1000000.01]
+    assert list(errors) == [False, False, False, False, True]
+
+
+def test_ranges_and_empty_prices_are_errors():
+    prices = ["R$ 1.299,00 - R$ 1.499,00", "", "R$ 10,00"]
+    values, errors = parse_prices(prices)
+    assert list(errors) == [True, True, False]
+    assert values[2] == 10.0
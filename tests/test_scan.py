@@ -0,0 +1,88 @@
+import time
+
+import DriverLib
+from DriverLib import Offer, Scan, ShopDriver
+
+
+class FakeDriver(ShopDriver):
+    shop = "Fake"
+
+    def get_product(self, product, **kwargs):
+        return [
+            Offer("{} {}".format(product, i), float(i), self.shop) for i in range(5)
+        ]
+
+
+def test_scan_frames_can_be_copied():
+    scan = Scan(browser=object())
+    scan.drivers = [FakeDriver]
+    for df in [scan.scan("tv"), scan.scan_many(["tv", "monitor"])]:
+        # pandas deep copies attrs on each operation
+        assert len(df.sort_values("price").copy().reset_index().head(3)) == 3
+        assert len(df[df.price < 2]) == len(df) * 2 // 5
+    assert scan.metrics is not None
+
+
+class FakeBrowser(object):
+    current_url = "about:blank"
+    window_handles = ["main"]
+
+    class switch_to(object):
+        @staticmethod
+        def window(handle):
+            pass
+
+    def delete_all_cookies(self):
+        pass
+
+    def execute_script(self, script):
+        pass
+
+    def get(self, url):
+        pass
+
+    def quit(self):
+        pass
+
+
+class SlowDriver(ShopDriver):
+    def get_product(self, product, **kwargs):
+        self.attach(self.browser_factory())
+        time.sleep(0.3)
+        self.failed = False
+        return [Offer(product, 1.0, self.shop)]
+
+
+def test_timeout_does_not_count_the_wait_for_a_browser(monkeypatch):
+    monkeypatch.setattr(DriverLib, "get_browser", lambda *args, **kwargs: FakeBrowser())
+    scan = Scan(pool_size=2)
+    scan.drivers = [
+        type("Slow{}".format(i), (SlowDriver,), {"shop": "Slow{}".format(i)})
+        for i in range(6)
+    ]
+    try:
+        events = list(scan.iter_scan("tv", timeout=0.45))
+    finally:
+        scan.close()
+    assert sorted(e.shop for e in events if e.status == "done") == [
+        "Slow{}".format(i) for i in range(6)
+    ]
+    assert scan.errors == {}
+
+
+def test_close_quits_the_browser_still_warming(monkeypatch):
+    browsers = []
+
+    def slow_browser(*args, **kwargs):
+        time.sleep(0.3)
+        browsers.append(FakeBrowser())
+        return browsers[-1]
+
+    monkeypatch.setattr(DriverLib, "get_browser", slow_browser)
+    monkeypatch.setattr(FakeBrowser, "quit", lambda self: browsers.remove(self))
+    # The scan warms a browser, closed before it is up
+    scan = Scan()
+    scan.close()
+    # A leaked browser would be up by now
+    time.sleep(0.5)
+    assert browsers == []